@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of gitdb2 internals. Run with `python benchmarks.py`."""
+from __future__ import print_function, division, absolute_import
+
+import datetime
+import random
+import shutil
+import tempfile
+from timeit import default_timer
+
+import sqlalchemy.ext.declarative
+from sqlalchemy import Column, Integer, String, DateTime, Boolean
+
+from gitdb2 import GitDBRepo, GroupCommitPolicy
+from gitdb2.data_types import TypeManager
+from gitdb2.layouts import RowPerFileLayout, PackedLayout, PrefixSharding, HashSharding
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+
+class Row(Base):
+    __tablename__ = 'rows'
+    id = Column(Integer, primary_key=True)
+    name = Column('row_name', String)
+    created = Column(DateTime)
+    active = Column(Boolean)
+    count = Column(Integer)
+    text = Column(String)
+    __content__ = 'text'
+
+
+def legacy_dump(obj):
+    """Serializer as used before the row codecs"""
+    output = ''
+    content_name = getattr(obj, '__content__', None)
+    for name in obj.__mapper__.columns.keys():
+        if name == content_name:
+            continue
+        col_name = obj.__mapper__.columns[name].name
+        value = getattr(obj, name)
+        if value is None:
+            continue
+        for t in TypeManager.type_dict:
+            if isinstance(obj.__mapper__.columns[name].type, t):
+                value_str = TypeManager.type_dict[t].to_string(value)
+                break
+        output += u'{0}: {1}\n'.format(col_name, value_str)
+    if content_name:
+        output += '\n'
+        output += getattr(obj, content_name)
+    return output
+
+def legacy_parse(klazz, data):
+    """Deserializer as used before the row codecs"""
+    values = {}
+    parts = data.split('\n\n', 1)
+    if len(parts)>1:
+        meta, content = parts
+    else:
+        meta, content = parts[0], None
+    for line in meta.split('\n'):
+        if line:
+            key, value = line.split(': ', 1)
+            col = klazz.__table__.columns.get(key)
+            if col is not None:
+                for t in TypeManager.type_dict:
+                    if isinstance(col.type, t):
+                        values[key] = TypeManager.type_dict[t].from_string(value)
+                        break
+    if content != None:
+        values[klazz.__content__] = content
+    for key in klazz.__table__.columns.keys():
+        if key not in values:
+            values[key] = None
+    return values
+
+
+def rows_per_second(function, items, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for item in items:
+            function(item)
+        duration = default_timer() - start
+        if best is None or duration < best:
+            best = duration
+    return len(items) / best
+
+def report(name, legacy, codec):
+    print('{0:<8} legacy: {1:>10.0f} rows/s  codec: {2:>10.0f} rows/s  ({3:.1f}x)'.format(
+        name, legacy, codec, codec / legacy))
+
+def benchmark_codec(count=20000):
+    now = datetime.datetime(2016, 1, 1, 12, 0, 0)
+    rows = [Row(id=i, name='row {0}'.format(i), created=now, active=bool(i % 2),
+                count=i * 3, text='some\ncontent {0}'.format(i))
+            for i in range(count)]
+    codec = TypeManager.get_codec(Row)
+    assert legacy_dump(rows[0]) == codec.dump(rows[0])
+    report('dump', rows_per_second(legacy_dump, rows), rows_per_second(codec.dump, rows))
+
+    texts = [codec.dump(row) for row in rows]
+    assert legacy_parse(Row, texts[0]) == codec.parse(texts[0])
+    report('parse', rows_per_second(lambda text: legacy_parse(Row, text), texts),
+           rows_per_second(codec.parse, texts))
+
+
+def benchmark_layouts(count=20000, commits=20, rows_per_commit=50):
+    """Measure the cost of a commit changing a few random rows
+       of a table of `count` rows for different layouts"""
+    layouts = [
+        ('prefix', RowPerFileLayout(PrefixSharding())),
+        ('hash 1x2', RowPerFileLayout(HashSharding(depth=1))),
+        ('hash 2x2', RowPerFileLayout(HashSharding(depth=2))),
+        ('packed', PackedLayout(buckets=256)),
+    ]
+    for name, layout in layouts:
+        LayoutBase = sqlalchemy.ext.declarative.declarative_base()
+        class LayoutRow(LayoutBase):
+            __tablename__ = 'rows'
+            __layout__ = layout
+            id = Column(Integer, primary_key=True)
+            name = Column(String)
+        path = tempfile.mkdtemp()
+        try:
+            repo = GitDBRepo.init(LayoutBase, path, update_working_copy=False)
+            repo.session.add_all([LayoutRow(id=i, name='row {0}'.format(i)) for i in range(count)])
+            repo.session.commit()
+            ids = list(range(count))
+            start = default_timer()
+            for commit in range(commits):
+                for i in random.sample(ids, rows_per_commit):
+                    repo.session.query(LayoutRow).get(i).name = 'commit {0}'.format(commit)
+                repo.session.commit()
+            duration = (default_timer() - start) / commits
+            repo.close()
+        finally:
+            shutil.rmtree(path)
+        print('{0:<10} {1:>8.1f} ms per commit of {2} rows'.format(name, duration * 1000, rows_per_commit))
+
+
+def benchmark_object_writers(count=20000):
+    """Measure a transaction inserting `count` rows with loose objects
+       and with a packfile per commit"""
+    for name, pack_objects in [('loose', False), ('pack', True)]:
+        WriterBase = sqlalchemy.ext.declarative.declarative_base()
+        class WriterRow(WriterBase):
+            __tablename__ = 'rows'
+            id = Column(Integer, primary_key=True)
+            name = Column(String)
+        path = tempfile.mkdtemp()
+        try:
+            repo = GitDBRepo.init(WriterBase, path, update_working_copy=False,
+                                  pack_objects=pack_objects)
+            repo.session.add_all([WriterRow(id=i, name='row {0}'.format(i)) for i in range(count)])
+            start = default_timer()
+            repo.session.commit()
+            duration = default_timer() - start
+            repo.close()
+        finally:
+            shutil.rmtree(path)
+        print('{0:<10} {1:>8.0f} rows/s in a transaction of {2} rows'.format(name, count / duration, count))
+
+
+def benchmark_group_commit(transactions=500):
+    """Measure many transactions changing a single row each
+       with and without group commit"""
+    for name, group_commit in [('single', None), ('group', GroupCommitPolicy(max_delay=0.1))]:
+        GroupBase = sqlalchemy.ext.declarative.declarative_base()
+        class GroupRow(GroupBase):
+            __tablename__ = 'rows'
+            id = Column(Integer, primary_key=True)
+            name = Column(String)
+        path = tempfile.mkdtemp()
+        try:
+            repo = GitDBRepo.init(GroupBase, path, update_working_copy=False,
+                                  group_commit=group_commit)
+            start = default_timer()
+            for i in range(transactions):
+                repo.session.add(GroupRow(id=i, name='row {0}'.format(i)))
+                repo.session.commit()
+            repo.flush()
+            duration = default_timer() - start
+            repo.close()
+        finally:
+            shutil.rmtree(path)
+        print('{0:<10} {1:>8.0f} transactions/s'.format(name, transactions / duration))
+
+
+if __name__ == '__main__':
+    benchmark_codec()
+    benchmark_layouts()
+    benchmark_object_writers()
+    benchmark_group_commit()
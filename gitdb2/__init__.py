@@ -1,4 +1,5 @@
 from __future__ import print_function, absolute_import, division
 
 from .base import *
-
+from .layouts import get_filename, RowPerFileLayout, PackedLayout, PrefixSharding, \
+    HashSharding
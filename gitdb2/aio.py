@@ -0,0 +1,98 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .base import GitDBRepo
+
+"""
+   asyncio interface of gitdb2 (Python 3.5+, not imported by `gitdb2`).
+
+   `AsyncGitDBRepo` runs a `GitDBRepo` in a dedicated thread. Opening the
+   repository, including rebuilding the database, commits, working copy
+   updates and queries all happen in that thread, so the event loop is never
+   blocked. Calls are executed one after the other in the order they were
+   made, so commits keep their order. The session must only be used in that
+   thread, i.e. in functions passed to `run`:
+
+       async with AsyncGitDBRepo(Base, path) as repo:
+           await repo.run(lambda session: session.add(Test(foo='probe')))
+           await repo.commit()
+           count = await repo.run(lambda session: session.query(Test).count())
+
+   Cancelling a call does not cancel the work in the thread; calls made
+   later still wait for it.
+"""
+
+
+class AsyncGitDBRepo(object):
+    """Opens GitDBRepo(Base, path, **kwargs) in a thread of its own on
+    `open` or when entering the context"""
+    def __init__(self, Base, path, **kwargs):
+        self.Base = Base
+        self.path = path
+        self.kwargs = kwargs
+        self.executor = None
+        self.repo = None
+
+    async def call(self, function, *args, **kwargs):
+        """Call function in the thread of the repository and return its
+        result"""
+        if self.executor is None:
+            raise RuntimeError('The repository is not open')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def open(self, init=False):
+        """Open the repository, creating it first if `init` is set"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+        if init:
+            self.repo = await self.call(GitDBRepo.init, self.Base, self.path, **self.kwargs)
+        else:
+            self.repo = await self.call(GitDBRepo, self.Base, self.path, **self.kwargs)
+        return self
+
+    async def run(self, function, *args, **kwargs):
+        """Call function(session, *args, **kwargs) in the thread of the
+        repository and return its result"""
+        return await self.call(lambda: function(self.repo.session, *args, **kwargs))
+
+    async def commit(self):
+        """Commit the session, and with it the changes to git"""
+        await self.call(lambda: self.repo.session.commit())
+
+    async def rollback(self):
+        await self.call(lambda: self.repo.session.rollback())
+
+    async def flush(self):
+        """Commit the transactions waiting for a group commit to git"""
+        await self.call(lambda: self.repo.flush())
+
+    async def refresh(self):
+        """Update the database to the commits of other writers"""
+        await self.call(lambda: self.repo.refresh())
+
+    async def switch_branch(self, branch):
+        await self.call(lambda: self.repo.switchBranch(branch))
+
+    async def close(self):
+        if self.executor is None:
+            return
+        try:
+            if self.repo is not None:
+                await self.call(self.repo.close)
+        finally:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.repo = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.repo is not None:
+            await self.rollback()
+        await self.close()
@@ -1,20 +1,35 @@
 from __future__ import print_function, absolute_import, division, unicode_literals
 
-from sqlalchemy.orm import attributes, sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session, object_session
 from sqlalchemy import event
 import sqlalchemy as sa
+from six import string_types
 
 
-import subprocess as sp
 import os
 import errno
 import glob
 import codecs
+import sqlite3
+import threading
+import warnings
+import weakref
+import subprocess as sp
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from time import sleep
+from timeit import default_timer
 
 from .data_types import TypeManager
-from .git_handling import GitHandler
-from pygit2 import Repository, Tree, GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE
+from .snapshot_cache import SnapshotCache, schema_fingerprint
+from .maintenance import RepositoryMaintenance
+from .group_commit import GroupCommitPolicy
+from .layouts import get_blob_filename, get_layout, iter_row_texts, holds_rows, \
+    parse_bucket, dump_bucket
+from .git_handling import GitHandler, ConflictError, diff_trees, iter_blobs, empty_tree_id
+from pygit2 import Repository, Tree, GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE, \
+    init_repository, Oid, GitError
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,13 +46,43 @@ logger.setLevel(logging.INFO)
    Use association_proxies instead. Do not forget to set 'cascade="all, delete-orphan"'
    in order for association_proxy.remove() to work.
 
-   Bulk updates and bulk deletes are not supported at the moment (i.e., Query.update(),
-   Query.delete(). This is because GitDB cannot get the precise rows updated or deleted.
-   GitDB will raise an NotImplementedError if bulk updates or bulk deletes occur in its
-   session. In a later version, this might be overcome by explicitly checking all objects
-   of the respective table and e.g., delete all files without a table row.
+   Bulk updates and bulk deletes (i.e., Query.update(), Query.delete()) select the
+   primary keys of the matching rows before the statement is executed, for updates
+   together with the primary keys the rows will have afterwards. Updated rows are
+   read again by their new keys, and the files of all affected rows are written or
+   removed in the current transaction, i.e. in the same git commit.
+
+   Core inserts into mapped tables in the session (e.g. `session.execute(
+   table.insert(), rows)` or `session.bulk_insert_mappings()`) are written
+   straight from their parameters, without constructing objects. Rows are
+   read back from the database if the parameters lack primary keys or columns
+   with server defaults. Core updates and deletes whose WHERE clause binds the
+   whole primary key to parameters, like those of `bulk_update_mappings()`
+   and of updates by `bulk_save_objects()`, are handled by reading the rows
+   back by key. Other Core updates and deletes of mapped tables, including
+   updates of primary keys, raise a NotImplementedError; use Query.update()
+   and Query.delete() instead.
 
    newlines in string columns are escaped to r'\n' when saved to file.
+
+   LargeBinary columns, and text columns with `info={'gitdb_blob': True}`, are
+   stored unescaped in blobs of their own next to the row file
+   (e.g. "table/1.payload.blob"). The row file only holds the id of the blob,
+   so identical values are stored only once.
+
+   Several processes can write to the same repository if each has a database
+   of its own, e.g. with `in_memory=True` and `update_working_copy=False`.
+   Commits are serialized by a lock file in the git directory. If another
+   writer has moved HEAD, the changes are rebased onto it and the database
+   is updated with the changes of the other writer. Changes of the same row
+   file, or of the same row of a packed table, raise a `ConflictError`; the
+   transaction is then lost and the database matches HEAD again.
+   `GitDBRepo.refresh()` reads the commits of other writers without writing.
+
+   `GitDBRepo(..., branch=...)` reads and commits to another branch than
+   master. `switchBranch()` keeps a snapshot of the database per branch tip
+   in ".git/gitdb2", so switching back and forth restores a snapshot or
+   applies a small tree diff instead of rebuilding the database.
 """
 
 #class MyFormatter(logging.Formatter):
@@ -67,14 +112,23 @@ logger.setLevel(logging.INFO)
 #logger.addHandler(console)
 
 
-def get_filename(tablename, primary_key):
-    primary_key_name = str(primary_key)
-    if len(primary_key_name) > 3:
-        prefix = primary_key_name[:2]
-        return '{0}/{1}/{2}.txt'.format(tablename, prefix, primary_key_name)
-    else:
-        return '{0}/{1}.txt'.format(tablename, primary_key_name)
+@contextmanager
+def timed(timings, phase):
+    """Add the time spent in the with block to timings[phase]"""
+    start = default_timer()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + default_timer() - start
+
 
+def iter_mapped_classes(klazz):
+    """Yield klazz and all its subclasses that are mapped to a table"""
+    if hasattr(klazz, '__mapper__'):
+        yield klazz
+    for sub_klazz in klazz.__subclasses__():
+        for mapped_klazz in iter_mapped_classes(sub_klazz):
+            yield mapped_klazz
 
 
 def makedirs(dirname):
@@ -88,8 +142,28 @@ def makedirs(dirname):
         if e.errno != errno.EEXIST:
             raise
 
+# the open GitDBSessions. Query events cannot be limited to a session, so a
+# single listener passes them on to all GitDBSessions, which check
+# query.session (see owns_session). The sessions are only referenced weakly,
+# so that sessions that are never closed are not kept alive.
+open_sessions = weakref.WeakSet()
+
+@event.listens_for(sa.orm.Query, "before_compile_delete")
+def before_compile_delete(query, delete_context):
+    for gitdb_session in list(open_sessions):
+        gitdb_session.before_bulk_delete(query, delete_context)
+
+@event.listens_for(sa.orm.Query, "before_compile_update")
+def before_compile_update(query, update_context):
+    for gitdb_session in list(open_sessions):
+        gitdb_session.before_bulk_update(query, update_context)
+
 class GitDBSession(object):
-    def __init__(self, session, path, Base=None, update_working_copy=True):
+    def __init__(self, session, path, Base=None, update_working_copy=True, pack_objects=False,
+                 maintenance=None, working_copy_workers=0, group_commit=None,
+                 branch='master', threadsafe=False):
+        """`session` may be a `scoped_session` in `threadsafe` mode, in which
+           case every thread has a transaction of its own."""
         #self.logger = logger.getChild('session')
         self.session = session
         self.new = set()
@@ -98,15 +172,28 @@ class GitDBSession(object):
         self.path = path
         self.Base = Base
         self.active=True
-        self.git_handler = GitHandler(self.path, update_working_copy=update_working_copy)
+        self.local = threading.local()
+        self.git_handler = GitHandler(self.path, update_working_copy=update_working_copy,
+                                      pack_objects=pack_objects, maintenance=maintenance,
+                                      working_copy_workers=working_copy_workers,
+                                      group_commit=group_commit, branch=branch,
+                                      threadsafe=threadsafe)
         event.listen(session, "after_commit", self.after_commit)
         event.listen(session, "after_rollback", self.after_rollback)
+        event.listen(session, "after_transaction_end", self.after_transaction_end)
+        event.listen(session, "after_begin", self.after_begin)
+        event.listen(session, "before_flush", self.before_flush)
+        event.listen(session, "after_flush", self.after_flush)
         event.listen(session, "after_bulk_delete", self.after_bulk_delete)
         event.listen(session, "after_bulk_update", self.after_bulk_update)
+        open_sessions.add(self)
 
+        # table -> mapped class, for Core statements
+        self.mapped_tables = {}
         if self.Base:
             def register_class(klazz):
                 if hasattr(klazz, '__mapper__'):
+                    self.mapped_tables.setdefault(klazz.__table__, klazz)
                     event.listen(klazz.__mapper__, 'after_delete', self.after_delete)
                     event.listen(klazz.__mapper__, 'after_insert', self.after_insert)
                     event.listen(klazz.__mapper__, 'after_update', self.after_update)
@@ -114,261 +201,1219 @@ class GitDBSession(object):
                     register_class(sub_klazz)
             register_class(self.Base)
     def close(self):
+        open_sessions.discard(self)
         self.active=False
+        self.git_handler.close()
+    def flush(self):
+        """Commit the transactions waiting for a group commit to git"""
+        self.git_handler.flush()
+
+    @property
+    def pending_buckets(self):
+        """Changes of rows of packed tables of the current transaction by
+           bucket filename, written when the transaction is committed"""
+        pending_buckets = getattr(self.local, 'pending_buckets', None)
+        if pending_buckets is None:
+            pending_buckets = self.local.pending_buckets = {}
+        return pending_buckets
+
+    @pending_buckets.setter
+    def pending_buckets(self, pending_buckets):
+        self.local.pending_buckets = pending_buckets
+
+    def owns(self, target):
+        """Return whether target belongs to the session of this thread"""
+        return self.owns_session(object_session(target))
+
+    def owns_session(self, session):
+        """Return whether session is the session of this thread"""
+        own_session = self.session
+        if isinstance(own_session, scoped_session):
+            if not own_session.registry.has():
+                return False
+            own_session = own_session()
+        return session is own_session
+
+    @contextmanager
+    def untracked(self):
+        """Core statements of this thread are not written to git meanwhile,
+           e.g. while tables are filled from git"""
+        self.local.untracked = getattr(self.local, 'untracked', 0) + 1
+        try:
+            yield
+        finally:
+            self.local.untracked -= 1
+
+    def getStatementClass(self, statement):
+        """Return the mapped class whose table is changed by the Core
+           statement, or None if the statement is not written by Core
+           events, e.g. as part of a flush"""
+        if not isinstance(statement, sa.sql.expression.UpdateBase) or \
+                getattr(self.local, 'flushing', False) or \
+                getattr(self.local, 'untracked', 0) or \
+                getattr(self.local, 'bulk_keys', None) is not None:
+            return None
+        return self.mapped_tables.get(statement.table)
 
     def getFilename(self, obj, old=True):
-        old_primary_keys = []
-        primary_keys = []
-        for name in obj.__mapper__.columns.keys():
-            col = obj.__mapper__.columns[name]
-            if col.primary_key:
-                history = attributes.get_history(obj, name)
-                #print history
-                if not history.deleted or history.deleted[0] == None:
-                    old_primary_keys.append(str(getattr(obj, name)))
-                else:
-                    old_primary_keys.append(str(history.deleted[0]))
-                primary_keys.append(str(getattr(obj, name)))
-        oldprimarykey = ','.join(old_primary_keys)
-        primarykey = ','.join(primary_keys)
-        filename = get_filename(obj.__tablename__, primarykey)
-        oldfilename = get_filename(obj.__tablename__, oldprimarykey)
+        codec = TypeManager.get_codec(type(obj))
+        layout = get_layout(type(obj))
+        filename = layout.get_filename(obj.__tablename__, codec.primary_key(obj))
         if old:
+            oldfilename = layout.get_filename(obj.__tablename__, codec.old_primary_key(obj))
             return filename, oldfilename
         else:
             return filename
 
     def writeObject(self, obj):
         filename, oldfilename = self.getFilename(obj, old=True)
-        if oldfilename!=filename:
-            #self.logger.debug("Primarykey changed from {0} to {1}!".format(oldfilename, filename))
-            self.git_handler.move_file(oldfilename, filename)
-        real_filename = os.path.join(self.path, filename)
-
-        #print real_filename
-
-        output = ''
+        codec = TypeManager.get_codec(type(obj))
+        blob_ids = self.writeBlobs(obj, codec, filename, oldfilename)
+        output = codec.dump(obj, blob_ids)
+        get_layout(type(obj)).write_row(self, obj.__tablename__, codec.primary_key(obj),
+                                        codec.old_primary_key(obj), output)
 
-        #print "Starting outfile"
-        if hasattr(obj, '__content__'):
-            content_name = obj.__content__
-        else:
-            content_name = None
-        for name in obj.__mapper__.columns.keys():
-            if name == content_name:
-                continue
-            col_name = obj.__mapper__.columns[name].name
-            value = getattr(obj, name)
+    def writeBlobs(self, obj, codec, filename, oldfilename):
+        """Write the blob columns of obj next to its row file and return
+           their blob ids by column name. Blobs of unchanged columns are
+           neither hashed nor written again."""
+        blob_ids = {}
+        if not codec.blob_fields:
+            return blob_ids
+        attrs = sa.inspect(obj).attrs
+        for attr_name, key, col_name, gitdb_type in codec.blob_fields:
+            blob_filename = get_blob_filename(filename, col_name)
+            old_blob_filename = get_blob_filename(oldfilename, col_name)
+            # check the history first, so that unchanged (e.g. deferred)
+            # values are not loaded
+            if not attrs[attr_name].history.has_changes():
+                blob_id = self.git_handler.get_blob_id(old_blob_filename)
+                if blob_id is not None:
+                    if old_blob_filename != blob_filename:
+                        self.git_handler.move_file(old_blob_filename, blob_filename)
+                    blob_ids[col_name] = blob_id.hex
+                    continue
+            value = getattr(obj, attr_name)
             if value is None:
+                self.git_handler.remove_file(old_blob_filename)
                 continue
-            for t in TypeManager.type_dict:
-                if isinstance(obj.__mapper__.columns[name].type, t):
-                    value_str = TypeManager.type_dict[t].to_string(value)
-                    break
-            #print "line", col_name
-            #print value_str
-            line = u'{0}: {1}\n'.format(col_name, value_str)
-            #print line
-            #self.logger.debug('%r' % line)
-            output += line
-            #print 'lab'
-        if content_name:
-            value = getattr(obj, content_name)
-            output += '\n'
-            output += value
-
-        self.git_handler.write_file(filename, output)
+            if old_blob_filename != blob_filename:
+                self.git_handler.remove_file(old_blob_filename)
+            blob_id = self.git_handler.write_bytes(blob_filename, gitdb_type.to_bytes(value))
+            blob_ids[col_name] = blob_id.hex
+        return blob_ids
 
     def deleteObject(self, obj):
         #self.logger.debug("DELETE")
         filename, oldfilename = self.getFilename(obj, old=True)
+        codec = TypeManager.get_codec(type(obj))
 
-        self.git_handler.remove_file(oldfilename)
+        get_layout(type(obj)).delete_row(self, obj.__tablename__, codec.old_primary_key(obj))
+        for attr_name, key, col_name, gitdb_type in codec.blob_fields:
+            self.git_handler.remove_file(get_blob_filename(oldfilename, col_name))
+
+    def writeBuckets(self):
+        """Rewrite the bucket files of packed tables changed in this transaction"""
+        for bucket_filename, changes in self.pending_buckets.items():
+            blob_id = self.git_handler.get_blob_id(bucket_filename)
+            if blob_id is None:
+                rows = {}
+            else:
+                rows = parse_bucket(self.git_handler.read_blob(blob_id).decode('utf-8'))
+            for key, text in changes.items():
+                if text is None:
+                    rows.pop(key, None)
+                else:
+                    rows[key] = text
+            if rows:
+                self.git_handler.write_file(bucket_filename, dump_bucket(rows))
+            else:
+                self.git_handler.remove_file(bucket_filename)
+        self.pending_buckets = {}
 
 
     def after_commit(self, session):
         if not self.active: return
         print("pre After commit!!!")
-        self.git_handler.commit()
+        # the buckets have to be read after the transactions before
+        self.git_handler.wait_for_turn()
+        self.writeBuckets()
+        try:
+            self.git_handler.commit()
+        except ConflictError:
+            # The database has been reset to the commits of the other
+            # writer. End the transaction, so that the session stays usable.
+            session.expire_all()
+            session.transaction.close()
+            raise
 
         print("post After commit!!!")
     def after_rollback(self, session):
         if not self.active: return
+        self.pending_buckets = {}
         self.git_handler.reset()
+    def after_transaction_end(self, session, transaction):
+        if not self.active or not self.owns_session(session): return
+        # a failed flush ends its subtransaction without after_flush
+        self.local.flushing = False
+        self.local.bulk_keys = None
+        if transaction.parent is not None: return
+        # closing a session ends its transaction without a rollback
+        self.pending_buckets = {}
+        self.git_handler.discard_transaction()
+    def after_begin(self, session, transaction, connection):
+        if not self.active or not self.owns_session(session): return
+        if not event.contains(connection, 'after_execute', self.after_execute):
+            event.listen(connection, 'before_execute', self.before_execute)
+            event.listen(connection, 'after_execute', self.after_execute)
+    def before_flush(self, session, flush_context, instances):
+        # the statements of a flush are written by the mapper events
+        self.local.flushing = True
+    def after_flush(self, session, flush_context):
+        self.local.flushing = False
 
-    def after_delete(self, mapper, connection, target):
+    def before_execute(self, conn, clauseelement, multiparams, params):
+        if not self.active: return
+        klazz = self.getStatementClass(clauseelement)
+        if klazz is None: return
+        if not isinstance(clauseelement, sa.sql.expression.Insert):
+            if get_key_parameters(clauseelement, multiparams) is None:
+                raise NotImplementedError('GitDB can only handle Core updates and deletes of {0} '
+                                          'by primary key, use Query.update() and '
+                                          'Query.delete()'.format(klazz.__tablename__))
+            return
+        # rows without primary key in the parameters are found by rowid
+        self.local.last_rowid = conn.execute(
+            sa.select([sa.func.max(sa.literal_column('rowid'))]).select_from(klazz.__table__)).scalar()
+    def after_execute(self, conn, clauseelement, multiparams, params, result):
         if not self.active: return
+        klazz = self.getStatementClass(clauseelement)
+        if klazz is None: return
+        table = klazz.__table__
+        codec = TypeManager.get_codec(klazz)
+        if not isinstance(clauseelement, sa.sql.expression.Insert):
+            # the changed rows are read back by the primary keys in the
+            # parameters, rows that are gone have been deleted
+            key_names = get_key_parameters(clauseelement, multiparams)
+            keys = OrderedDict()
+            for parameters in result.context.compiled_parameters:
+                key = {col.key: parameters[name] for col, name in key_names.items()}
+                keys[codec.values_filename_key(key)] = key
+            rows = {}
+            for values in self.selectRowsByKey(conn, table, list(keys.values())):
+                rows[codec.values_filename_key(values)] = values
+            self.writeBulkRows(klazz, [(key, rows.get(key)) for key in keys])
+            return
+        # missing server defaults are only known to the database
+        read_columns = [col.key for col in table.primary_key.columns] + \
+                       [col.key for col in table.columns if col.server_default is not None]
+        rows = OrderedDict()
+        read_keys = []
+        read_new = clauseelement.select is not None
+        for parameters in result.context.compiled_parameters:
+            values = {key: parameters.get(key) for key in table.columns.keys()}
+            if any(parameters.get(key) is None for key in read_columns):
+                if all(values[col.key] is not None for col in table.primary_key.columns):
+                    read_keys.append(values)
+                else:
+                    read_new = True
+                continue
+            rows[codec.values_filename_key(values)] = values
+        read = list(self.selectRowsByKey(conn, table, read_keys))
+        if read_new:
+            statement = table.select()
+            if self.local.last_rowid is not None:
+                statement = statement.where(sa.literal_column('rowid') > self.local.last_rowid)
+            read.extend({key: row[col] for key, col in table.columns.items()}
+                        for row in conn.execute(statement))
+        for values in read:
+            rows[codec.values_filename_key(values)] = values
+        self.writeBulkRows(klazz, list(rows.items()))
+
+    def after_delete(self, mapper, connection, target):
+        if not self.active or not self.owns(target): return
         #self.logger.debug("Instance %s being deleted" % target)
+        self.git_handler.begin_transaction()
         self.deleteObject(target)
-    def after_bulk_delete(self, session, query, query_context, result):
-        if not self.active: return
-        raise NotImplementedError('GitDB cannot yet handle bulk deletes!')
-        affected_table = query_context.statement.froms[0]
-        print(affected_table)
-        #affected_rows = query_context.statement.execute().fetchall()
-        affected_rows = session.execute(query_context.statement).fetchall()
-        print(affected_rows)
-        for res in  result.fetchall():
-            print(res)
-    def after_bulk_update(self, session, query, query_context, result):
-        if not self.active: return
-        raise NotImplementedError('GitDB cannot yet handle bulk updates!')
+    def before_bulk_delete(self, query, delete_context):
+        if not self.active or delete_context.mapper is None or \
+                not self.owns_session(query.session): return
+        self.local.bulk_keys = self.selectBulkKeys(query, delete_context.mapper)
+    def after_bulk_delete(self, delete_context):
+        if not self.active or not self.owns_session(delete_context.session): return
+        keys = getattr(self.local, 'bulk_keys', None)
+        if keys is None: return
+        self.local.bulk_keys = None
+        self.writeBulkRows(delete_context.mapper.class_,
+                           [(old_key, None) for old_key, new_key in keys])
+    def before_bulk_update(self, query, update_context):
+        if not self.active or update_context.mapper is None or \
+                not self.owns_session(query.session): return
+        self.local.bulk_keys = self.selectBulkKeys(query, update_context.mapper,
+                                                   update_context.values)
+    def after_bulk_update(self, update_context):
+        if not self.active or not self.owns_session(update_context.session): return
+        keys = getattr(self.local, 'bulk_keys', None)
+        if keys is None: return
+        self.local.bulk_keys = None
+        mapper = update_context.mapper
+        codec = TypeManager.get_codec(mapper.class_)
+        rows = {}
+        connection = update_context.session.connection(mapper=mapper)
+        for values in self.selectRowsByKey(connection, mapper.local_table,
+                                           [new_key for old_key, new_key in keys]):
+            rows[codec.values_filename_key(values)] = values
+        self.writeBulkRows(mapper.class_, [
+            (old_key, rows.get(codec.values_filename_key(new_key))) for old_key, new_key in keys])
+
+    def selectBulkKeys(self, query, mapper, values=None):
+        """Return the primary keys of the rows matched by the criteria of the
+           bulk statement `query` before it is executed, as list of (old key
+           as used in filenames, new key as dictionary). The new keys are
+           computed from `values`, the values of an update."""
+        session = query.session
+        # the statement itself autoflushes only after this hook
+        if query._autoflush and session.autoflush:
+            session.flush()
+        table = mapper.local_table
+        codec = TypeManager.get_codec(mapper.class_)
+        new_values = {}
+        if hasattr(values, 'items'):
+            values = values.items()
+        for key, value in values or []:
+            if isinstance(key, string_types):
+                key = getattr(mapper.class_, key)
+            if hasattr(key, 'property'):
+                for col in key.property.columns:
+                    new_values[col] = value
+            else:
+                new_values[key] = value
+        columns = list(table.primary_key.columns)
+        new_columns = []
+        for col in columns:
+            value = new_values.get(col, col)
+            if not isinstance(value, sa.sql.ClauseElement):
+                value = sa.literal(value, type_=col.type)
+            # a label, as a column is selected only once otherwise
+            new_columns.append(value.label('new_' + col.name))
+        statement = sa.select(columns + new_columns).select_from(table)
+        if query.whereclause is not None:
+            statement = statement.where(query.whereclause)
+        keys = []
+        for row in session.execute(statement, mapper=mapper, params=query._params):
+            old_key = {col.key: value for col, value in zip(columns, row[:len(columns)])}
+            new_key = {col.key: value for col, value in zip(columns, row[len(columns):])}
+            keys.append((codec.values_filename_key(old_key), new_key))
+        return keys
+
+    def selectRowsByKey(self, connection, table, keys, chunk_size=500):
+        """Yield the rows of `table` with primary keys `keys` as dictionaries,
+           selected in chunks below the sqlite limit of variables"""
+        columns = list(table.primary_key.columns)
+        if len(columns) == 1:
+            key_column = columns[0]
+            key_values = [key[columns[0].key] for key in keys]
+        else:
+            key_column = sa.tuple_(*columns)
+            key_values = [tuple([key[col.key] for col in columns]) for key in keys]
+        for start in range(0, len(key_values), chunk_size):
+            statement = table.select().where(
+                key_column.in_(key_values[start:start + chunk_size]))
+            for row in connection.execute(statement):
+                yield {key: row[col] for key, col in table.columns.items()}
+
+    def writeBulkRows(self, klazz, changes):
+        """Apply the rows changed by a bulk statement, a list of
+           (old primary key, values), where values is None for deleted rows"""
+        if not changes:
+            return
+        codec = TypeManager.get_codec(klazz)
+        layout = get_layout(klazz)
+        tablename = klazz.__tablename__
+        self.git_handler.begin_transaction()
+        # remove all old files first, so that a row may take over the
+        # primary key of another row in the same statement
+        for old_key, values in changes:
+            if values is not None and codec.values_filename_key(values) == old_key:
+                continue
+            layout.delete_row(self, tablename, old_key)
+            oldfilename = layout.get_filename(tablename, old_key)
+            for attr_name, key, col_name, gitdb_type in codec.blob_fields:
+                self.git_handler.remove_file(get_blob_filename(oldfilename, col_name))
+        for old_key, values in changes:
+            if values is None:
+                continue
+            key = codec.values_filename_key(values)
+            filename = layout.get_filename(tablename, key)
+            blob_ids = {}
+            for attr_name, col_key, col_name, gitdb_type in codec.blob_fields:
+                blob_filename = get_blob_filename(filename, col_name)
+                value = values.get(col_key)
+                if value is None:
+                    self.git_handler.remove_file(blob_filename)
+                else:
+                    blob_id = self.git_handler.write_bytes(blob_filename, gitdb_type.to_bytes(value))
+                    blob_ids[col_name] = blob_id.hex
+            layout.write_row(self, tablename, key, key, codec.dump_values(values, blob_ids))
     def after_insert(self, mapper, connection, target):
-        if not self.active: return
+        if not self.active or not self.owns(target): return
         #self.logger.debug("Instance %s being inserted" % target)
+        self.git_handler.begin_transaction()
         self.writeObject(target)
     def after_update(self, mapper, connection, target):
-        if not self.active: return
+        if not self.active or not self.owns(target): return
         #self.logger.debug("Instance %s being updated in %s" % (target, self))
+        self.git_handler.begin_transaction()
         self.writeObject(target)
 
 def construct_from_string(klazz, data):
     new_object = klazz()
-    parts = data.split('\n\n', 1)
-    if len(parts)>1:
-        meta, content = parts
-    else:
-        meta, content = parts[0], None
-    data = {}
-    name_dict = {klazz.__mapper__.columns[attr_name].name: attr_name for attr_name in klazz.__mapper__.columns.keys()}
-    for line in meta.split('\n'):
-        if line:
-            key, value=line.split(': ',1)
-            if key in name_dict:
-                col = klazz.__mapper__.columns[name_dict[key]]
-                for t in TypeManager.type_dict:
-                    if isinstance(col.type, t):
-                        real_value = TypeManager.type_dict[t].from_string(value)
-                        break
-                setattr(new_object, name_dict[key], real_value)
-    if content != None:
-        setattr(new_object, new_object.__content__, content)
+    codec = TypeManager.get_codec(klazz)
+    attr_names = {klazz.__mapper__.columns[attr_name].key: attr_name
+                  for attr_name in klazz.__mapper__.columns.keys()}
+    for key, value in codec.parse(data, fill=False).items():
+        setattr(new_object, attr_names[key], value)
     return new_object
 
 def construct_insert_values_from_string(klazz, data):
-    values = {}
-    parts = data.split('\n\n', 1)
-    if len(parts)>1:
-        meta, content = parts
+    return TypeManager.get_codec(klazz).parse(data)
+
+_worker_repositories = {}
+
+def _read_insert_values(repo_path, codec, blob_ids):
+    """Read and parse the rows in the files `blob_ids`, a list of
+       (filename, blob_id) pairs, in a setup worker process. Returns a list
+       of the insert values of each file."""
+    repo = _worker_repositories.get(repo_path)
+    if repo is None:
+        repo = _worker_repositories[repo_path] = Repository(repo_path)
+    read_blob = lambda blob_id: repo[blob_id].data
+    return [[codec.parse(text, read_blob=read_blob)
+             for text in iter_row_texts(filename, repo[blob_id].data)]
+            for filename, blob_id in blob_ids]
+
+def get_table_tree_id(tree, tablename):
+    """Return the id of the subtree of `tree` storing the table `tablename`,
+       or the id of the empty tree if the table has no rows"""
+    if tablename in tree:
+        return tree[tablename].id
+    return empty_tree_id
+
+def get_statement_tablenames(statement):
+    """Return the names of the tables used by a statement or None if they
+       cannot be determined, e.g. for textual SQL"""
+    if not isinstance(statement, sa.sql.ClauseElement) or \
+            isinstance(statement, sa.sql.expression.TextClause):
+        return None
+    tables = set(element for element in sa.sql.visitors.iterate(statement, {})
+                 if isinstance(element, sa.Table))
+    if isinstance(statement, sa.sql.expression.UpdateBase):
+        tables.add(statement.table)
+    return set(table.name for table in tables)
+
+def get_key_parameters(statement, multiparams):
+    """Return the names of the bind parameters giving the primary key of
+       the row changed by each parameter set of the Core UPDATE or DELETE
+       `statement`, by primary key column, e.g. for the statements of
+       `bulk_update_mappings()`. Returns None if the changed rows cannot be
+       told from the parameters or if primary keys are updated."""
+    table = statement.table
+    where = statement._whereclause
+    if where is None:
+        return None
+    if isinstance(where, sa.sql.expression.BooleanClauseList) and \
+            where.operator is sa.sql.operators.and_:
+        clauses = where.clauses
     else:
-        meta, content = parts[0], None
-    table_cols = klazz.__table__.columns.keys()
-    #name_dict = {klazz.__mapper__.columns[attr_name].name: attr_name for attr_name in klazz.__mapper__.columns.keys()}
-    for line in meta.split('\n'):
-        if line:
-            key, value=line.split(': ',1)
-            if key in table_cols:
-                col = klazz.__table__.columns[key]# klazz.__mapper__.columns[name_dict[key]]
-                for t in TypeManager.type_dict:
-                    if isinstance(col.type, t):
-                        real_value = TypeManager.type_dict[t].from_string(value)
-                        break
-                else:
-                    raise TypeError(col.type)
-                values[key] = real_value
-                #setattr(new_object, name_dict[key], real_value)
-    if content != None and hasattr(klazz, '__content__'):
-        values[klazz.__content__] = content
-    for key in table_cols:
-        if key not in values:
-            values[key] = None
-        #setattr(new_object, new_object.__content__, content)
-    return values
+        clauses = [where]
+    names = {}
+    for clause in clauses:
+        if not isinstance(clause, sa.sql.expression.BinaryExpression) or \
+                clause.operator is not sa.sql.operators.eq:
+            continue
+        column, parameter = clause.left, clause.right
+        if isinstance(column, sa.sql.expression.BindParameter):
+            column, parameter = parameter, column
+        if isinstance(parameter, sa.sql.expression.BindParameter) and \
+                table.primary_key.columns.contains_column(column):
+            names[column] = parameter.key
+    if len(names) != len(table.primary_key.columns):
+        return None
+    if isinstance(statement, sa.sql.expression.Update):
+        keys = set(getattr(key, 'key', key) for key in statement.parameters or {})
+        for multiparam in multiparams:
+            if isinstance(multiparam, dict):
+                multiparam = [multiparam]
+            for parameters in multiparam:
+                if isinstance(parameters, dict):
+                    keys.update(parameters)
+        if any(col.key in keys for col in table.primary_key.columns):
+            return None
+    return names
+
+# Bookkeeping of the tables that have been filled from git in lazy mode,
+# together with the id of the tree they have been filled from.
+hydration_metadata = sa.MetaData()
+hydration_table = sa.Table('gitdb_hydrated_tables', hydration_metadata,
+                           sa.Column('tablename', sa.String, primary_key=True),
+                           sa.Column('tree_id', sa.String))
+
+# Settings of the database connection while the database is rebuilt.
+# The previous values are restored afterwards.
+BULK_LOAD_PRAGMAS = OrderedDict([
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+])
+
+def iter_table_files(repo, tree):
+    """Yield (filename, blob_id) of the files storing rows in the table tree
+       `tree`, in tree order, streaming the tree"""
+    for filename, blob_id in iter_blobs(repo, tree):
+        if holds_rows(filename):
+            yield filename, blob_id
+
+def chunk_rows(codec, file_rows, chunk_size):
+    """Yield the insert values of `file_rows`, the lists of insert values
+       of consecutive files, in chunks of at least `chunk_size` rows, ending
+       at file boundaries, each sorted by primary key"""
+    insert_entries = []
+    for rows in file_rows:
+        insert_entries.extend(rows)
+        if len(insert_entries) >= chunk_size:
+            yield sort_by_primary_key(codec, insert_entries)
+            insert_entries = []
+    if insert_entries:
+        yield sort_by_primary_key(codec, insert_entries)
+
+def sort_by_primary_key(codec, insert_entries):
+    """Sort insert values by primary key, so that they are appended to
+       the table in order. Entries with incomparable keys stay unsorted."""
+    try:
+        return sorted(insert_entries, key=codec.values_primary_key)
+    except TypeError:
+        return insert_entries
 
 class GitDBRepo(object):
-    def __init__(self, Base, path, dbname='database.db', update_working_copy=True):
+    def __init__(self, Base, path, dbname='database.db', update_working_copy=True,
+                 setup_workers=1, setup_chunk_size=1000, lazy=False, in_memory=False,
+                 bulk_load=True, snapshot_cache=None, pack_objects=False, maintenance=None,
+                 working_copy_workers=0, group_commit=None, branch='master',
+                 threadsafe=False):
+        """
+        Open the gitdb repository in `path`.
+        `lazy`: if set, tables are not read from git when the database is
+            rebuilt, but only when a statement uses them for the first time.
+        `bulk_load`: rebuild the database with relaxed journaling and
+            syncing and create secondary indexes only after loading the
+            rows (see `bulkLoad`).
+        `in_memory`: keep the database in memory instead of the file
+            `dbname`. On `close`, the database is saved as snapshot of the
+            current commit in the git directory and restored on the next
+            start.
+        `setup_workers`: number of worker processes that read and parse
+            blobs when the database has to be rebuilt. With the default
+            of 1, everything happens in this process.
+        `setup_chunk_size`: number of rows that are parsed and inserted
+            at once when the database is rebuilt. This bounds the memory
+            used by a rebuild independently of the table sizes.
+        `pack_objects`: write the blobs and trees of each commit as a
+            single packfile instead of as loose objects.
+        `maintenance`: True or a `RepositoryMaintenance` to pack and prune
+            loose objects in the background once there are too many.
+        `working_copy_workers`: number of threads that update the working
+            copy in the background. With the default of 0, files are
+            written while the session is flushed.
+        `group_commit`: True or a `GroupCommitPolicy` to merge consecutive
+            transactions into one git commit. Transactions are only durable
+            after the next git commit, see `flush` and `gitdb2.group_commit`.
+        `branch`: the branch the database reflects and commits go to, see
+            also `switchBranch`.
+        `threadsafe`: `session` is a `scoped_session`, so that every thread
+            has a session and a git transaction of its own, e.g. in a
+            threaded web server. Only the tree writes and the branch updates
+            of the commits are serialized. Needs a database file.
+        """
+        self.timings = OrderedDict()
+        start = default_timer()
         self.Base = Base
         self.path = path
-        self.repo = Repository(self.path)
+        with timed(self.timings, 'open_repository'):
+            self.repo = Repository(self.path)
         self.dbname = dbname
+        self.branch = branch
+        if threadsafe and in_memory:
+            raise ValueError('The threadsafe mode needs a database file')
+        self.threadsafe = threadsafe
         self.update_working_copy = update_working_copy
+        self.pack_objects = pack_objects
+        self.working_copy_workers = working_copy_workers
+        if maintenance is True:
+            maintenance = RepositoryMaintenance(self.path)
+        self.maintenance = maintenance or None
+        if group_commit is True:
+            group_commit = GroupCommitPolicy()
+        self.group_commit = group_commit or None
+        self.setup_workers = setup_workers
+        self.setup_chunk_size = setup_chunk_size
+        self.lazy = lazy
+        self.bulk_load = bulk_load
+        if snapshot_cache is not None and not isinstance(snapshot_cache, SnapshotCache):
+            snapshot_cache = SnapshotCache(snapshot_cache)
+        self.snapshot_cache = snapshot_cache
+        self.schema_fingerprint = None
+        self.mapped_classes = OrderedDict()
+        for klazz in iter_mapped_classes(self.Base):
+            self.mapped_classes.setdefault(klazz.__tablename__, klazz)
+        self.hydrating = False
+        self.hydrated_stale = False
+        self.in_memory = in_memory
+        self.snapshot_path = os.path.join(self.repo.path, 'gitdb2')
         databasepath = os.path.join(self.path, self.dbname)
-        if not os.path.exists(databasepath):
+        if self.in_memory:
+            with timed(self.timings, 'read_dbcommit'):
+                commit = self.findSnapshot()
+                current_commit = self.getCurrentCommit()
+            if not commit:
+                self.startDatabase(refresh=True)
+            elif commit != current_commit:
+                self.startDatabase(refresh=False, last_commit=commit)
+            else:
+                self.startDatabase(refresh=False)
+        elif not os.path.exists(databasepath):
             self.startDatabase(refresh=True)
         else:
-            try:
-                with open(os.path.join(self.path, 'dbcommit')) as dbcommit_file:
-                    content = dbcommit_file.read()
-                    commit = content.split('\n')[0].strip()
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    commit = None
-                else:
-                    raise e
-            if commit != self.getCurrentCommit():
+            with timed(self.timings, 'read_dbcommit'):
+                try:
+                    with open(os.path.join(self.path, 'dbcommit')) as dbcommit_file:
+                        content = dbcommit_file.read()
+                        commit = content.split('\n')[0].strip()
+                except IOError as e:
+                    if e.errno == errno.ENOENT:
+                        commit = None
+                    else:
+                        raise e
+                current_commit = self.getCurrentCommit()
+            if not commit:
                 self.startDatabase(refresh=True)
+            elif commit != current_commit:
+                self.startDatabase(refresh=False, last_commit=commit)
             else:
                 self.startDatabase(refresh=False)
-    def startDatabase(self, refresh=False):
+        self.timings['total'] = default_timer() - start
+        logger.info("Started in %.3fs (%s)", self.timings['total'],
+                    ', '.join('{0}: {1:.3f}s'.format(phase, duration)
+                              for phase, duration in self.timings.items()
+                              if phase != 'total'))
+    def startDatabase(self, refresh=False, last_commit=None):
+        """Open the database. If `refresh` is set, the database is rebuilt
+           from the git repository. Otherwise, if `last_commit` is given, the
+           database is assumed to reflect this commit and is updated to the
+           current commit by applying the tree diff, falling back to a full
+           rebuild if the diff cannot be applied."""
         databasename = os.path.join(self.path, self.dbname)
-        if refresh:
+        if refresh and not self.in_memory:
             if os.path.exists(databasename):
                 os.remove(databasename)
+            # An interrupted rebuild must not be mistaken for a valid
+            # database of the last commit.
+            self.removeCurrentCommit()
         makedirs(os.path.dirname(self.path))
         dbengine = 'sqlite'
         enginepath = '{engine}:///{databasename}'.format(engine=dbengine, databasename = databasename)
 
-        self.engine = sa.create_engine(enginepath)
-        if refresh:
-            self.Base.metadata.create_all(self.engine)
-        Session = sa.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        if refresh:
-            logging.info("Refreshing database")
-            self.setup()
-            self.saveCurrentCommit()
+        with timed(self.timings, 'open_database'):
+            if self.in_memory:
+                # All sessions have to share the single connection to the
+                # in-memory database
+                self.engine = sa.create_engine('sqlite://', poolclass=sa.pool.StaticPool,
+                                               connect_args={'check_same_thread': False})
+                if not refresh:
+                    self.restoreSnapshot(last_commit or self.getCurrentCommit())
+            else:
+                self.engine = sa.create_engine(enginepath)
+            cached = refresh and self.fetchCachedDatabase(databasename)
+            if refresh and not cached and (self.lazy or not self.bulk_load):
+                self.Base.metadata.create_all(self.engine)
+                if self.lazy:
+                    hydration_metadata.create_all(self.engine)
+            Session = sa.orm.sessionmaker(bind=self.engine)
+            if self.threadsafe:
+                self.session = scoped_session(Session)
+            else:
+                self.session = Session()
+            self.hydrated = self.loadHydrated(self.engine)
+        if cached:
+            logger.info("Using database from snapshot cache")
+            with timed(self.timings, 'save_dbcommit'):
+                self.saveCurrentCommit()
+        elif refresh:
+            logger.info("Refreshing database")
+            if self.lazy:
+                pass
+            elif self.bulk_load:
+                with timed(self.timings, 'setup'):
+                    self.bulkLoad()
+            else:
+                with timed(self.timings, 'setup'):
+                    self.setup()
+            if not self.lazy:
+                with timed(self.timings, 'store_cached_database'):
+                    self.storeCachedDatabase(databasename)
+            with timed(self.timings, 'save_dbcommit'):
+                self.saveCurrentCommit()
+        elif last_commit is not None:
+            logger.info("Updating database from commit %s", last_commit)
+            with timed(self.timings, 'update'):
+                updated = self.update(last_commit)
+            if not updated:
+                logger.info("Cannot update database incrementally")
+                self.session.close()
+                self.engine.dispose()
+                return self.startDatabase(refresh=True)
+            with timed(self.timings, 'save_dbcommit'):
+                self.saveCurrentCommit()
         else:
-            logging.info("Reusing database")
-        self.gitDBSession = GitDBSession(self.session, self.path,
-                                         Base=self.Base,
-                                         update_working_copy=self.update_working_copy)
+            logger.info("Reusing database")
+        if self.lazy and self.hydrated is None:
+            # The database has been filled completely before
+            self.startHydrationBookkeeping()
+        elif not self.lazy and self.hydrated is not None:
+            with timed(self.timings, 'setup'):
+                self.finishHydration()
+        with timed(self.timings, 'start_session'):
+            self.gitDBSession = GitDBSession(self.session, self.path,
+                                             Base=self.Base,
+                                             update_working_copy=self.update_working_copy,
+                                             pack_objects=self.pack_objects,
+                                             maintenance=self.maintenance,
+                                             working_copy_workers=self.working_copy_workers,
+                                             group_commit=self.group_commit,
+                                             branch=self.branch,
+                                             threadsafe=self.threadsafe)
+        self.gitDBSession.git_handler.sync_callbacks.append(self.after_git_sync)
+        if self.lazy:
+            self.gitDBSession.git_handler.commit_callbacks.append(self.after_git_commit)
+            event.listen(self.engine, 'before_execute', self.before_execute)
+            event.listen(self.session, 'after_rollback', self.after_rollback)
     def setup(self):
-        def read_class(klazz):
-            insert_entries = []
-            if hasattr(klazz, '__mapper__'):
-                root_tree = self.repo[self.repo.head.target].tree
-                if klazz.__tablename__ in root_tree:
-                    sub_tree = self.repo[root_tree[klazz.__tablename__].id]
-                    def read_sub_tree(sub_tree):
-                        for tree_entry in sub_tree:
-                            #print(tree_entry, tree_entry.type, type(tree_entry.type), tree_entry.file)
-                            if tree_entry.type == 'tree':
-                                sub_sub_tree = self.repo[tree_entry.id]
-                                read_sub_tree(sub_sub_tree)
-                            else:
-                                logging.debug("Reading blob %s/%s" % (klazz.__tablename__, tree_entry.name))
-                                text = self.repo[tree_entry.id].data.decode('utf-8')
-                                insert_entries.append(construct_insert_values_from_string(klazz, text))
-                    read_sub_tree(sub_tree)
+        """Fill the empty database with the rows of the current commit.
+           The rows of each table are streamed from the tree and inserted in
+           chunks of `setup_chunk_size` rows, each sorted by primary key.
+           Only the order within a chunk is guaranteed: the chunks follow the
+           tree order of the files, which compares filenames as strings, so
+           that memory stays bounded by the chunk size.
+           With `setup_workers` > 1, the blobs are read and parsed by a pool
+           of worker processes, while this process inserts the parsed rows
+           in the same order as the serial path."""
+        self.loadTables()
+        self.session.commit()
+    def bulkLoad(self):
+        """Create and fill the database for a rebuild as fast as possible.
+           Journaling and syncing are relaxed while loading, and secondary
+           indexes are created after all rows have been inserted. An
+           interrupted bulk load leaves no dbcommit file, so the database is
+           rebuilt again on the next start."""
+        connection = self.session.connection()
+        settings = OrderedDict()
+        with timed(self.timings, 'bulk_load.pragmas'):
+            for pragma, value in BULK_LOAD_PRAGMAS.items():
+                settings[pragma] = connection.execute('PRAGMA {0}'.format(pragma)).scalar()
+                connection.execute('PRAGMA {0} = {1}'.format(pragma, value))
+        try:
+            with timed(self.timings, 'bulk_load.create_tables'):
+                for table in self.Base.metadata.sorted_tables:
+                    connection.execute(sa.schema.CreateTable(table))
+            with timed(self.timings, 'bulk_load.load'):
+                self.loadTables()
+            with timed(self.timings, 'bulk_load.create_indexes'):
+                for table in self.Base.metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.create(connection)
+            with timed(self.timings, 'bulk_load.commit'):
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            connection = self.session.connection()
+            for pragma, value in settings.items():
+                connection.execute('PRAGMA {0} = {1}'.format(pragma, value))
+            self.session.commit()
+    def loadTables(self):
+        """Insert the rows of all tables of the current commit, in the order
+           of the foreign key dependencies of the tables."""
+        if self.getCurrentCommit() is None:
+            return
+        root_tree = self.getCurrentTree()
+        executor = None
+        if self.setup_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.setup_workers)
+        try:
+            for table in self.Base.metadata.sorted_tables:
+                klazz = self.mapped_classes.get(table.name)
+                if klazz is None or klazz.__tablename__ not in root_tree:
+                    continue
+                start = default_timer()
+                sub_tree = self.repo[root_tree[klazz.__tablename__].id]
+                if executor is None:
+                    batches = self.readTable(klazz, sub_tree)
+                else:
+                    batches = self.readTableParallel(klazz, sub_tree, executor)
+                for insert_entries in batches:
                     if insert_entries:
                         self.session.execute(klazz.__table__.insert(), insert_entries)
-            for sub_klazz in klazz.__subclasses__():
-                read_class(sub_klazz)
+                logger.debug("Loaded table %s in %.3fs", table.name, default_timer() - start)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    def readTable(self, klazz, tree):
+        """Yield the insert values of all rows of `klazz` stored in `tree`
+           in chunks of `setup_chunk_size` rows (see `chunk_rows`)."""
+        codec = TypeManager.get_codec(klazz)
+        def read_files():
+            for filename, blob_id in iter_table_files(self.repo, tree):
+                logger.debug("Reading blob %s/%s" % (klazz.__tablename__, filename))
+                yield [codec.parse(text, read_blob=self.readBlob)
+                       for text in iter_row_texts(filename, self.repo[blob_id].data)]
+        return chunk_rows(codec, read_files(), self.setup_chunk_size)
+    def readBlob(self, blob_id):
+        return self.repo[blob_id].data
+    def readTableParallel(self, klazz, tree, executor):
+        """Like `readTable`, but parse the files in `executor`, in tasks of
+           `setup_chunk_size` files. The results are chunked by rows in file
+           order like in `readTable`, so that both insert the same chunks.
+           At most two tasks per worker are in flight at any time."""
+        codec = TypeManager.get_codec(klazz)
+        def read_files():
+            pending = deque()
+            def submit(blob_ids):
+                pending.append(executor.submit(_read_insert_values, self.repo.path,
+                                               codec, blob_ids))
+            blob_ids = []
+            for filename, blob_id in iter_table_files(self.repo, tree):
+                blob_ids.append((filename, blob_id.hex))
+                if len(blob_ids) >= self.setup_chunk_size:
+                    submit(blob_ids)
+                    blob_ids = []
+                    while len(pending) > 2 * self.setup_workers:
+                        for rows in pending.popleft().result():
+                            yield rows
+            if blob_ids:
+                submit(blob_ids)
+            while pending:
+                for rows in pending.popleft().result():
+                    yield rows
+        return chunk_rows(codec, read_files(), self.setup_chunk_size)
+    def update(self, last_commit):
+        """Update the database from `last_commit` to the current commit.
+           Only tables whose subtree changed are touched, and of those only
+           the rows whose files were added, modified or removed.
+           Returns False if the changes cannot be applied incrementally,
+           e.g. because `last_commit` is unknown or the schema changed."""
+        if self.getCurrentCommit() is None:
+            return False
+        try:
+            old_tree = self.repo[last_commit].tree
+        except (KeyError, ValueError):
+            return False
+        if not self.schemaMatches():
+            return False
+        new_tree = self.getCurrentTree()
+        try:
+            self.applyTreeDiff(old_tree, new_tree)
+            self.session.commit()
+        except (sa.exc.SQLAlchemyError, KeyError, TypeError, ValueError):
+            logger.exception("Failed to apply changes since %s", last_commit)
+            self.session.rollback()
+            return False
+        return True
+    def schemaMatches(self):
+        """Check that the tables of the database have the columns of the
+           tables in `Base.metadata`."""
+        inspector = sa.inspect(self.engine)
+        existing_tables = set(inspector.get_table_names())
+        for table in self.Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                return False
+            columns = set(col['name'] for col in inspector.get_columns(table.name))
+            if columns != set(col.name for col in table.columns):
+                return False
+        return True
+    def applyTreeDiff(self, old_tree, new_tree, connection=None, from_hydrated=True):
+        """Insert, update and delete the rows that differ between the
+           trees `old_tree` and `new_tree`. Tables whose subtree is unchanged
+           are skipped. In lazy mode, only tables that have been filled
+           already are updated, starting from the tree they have been
+           filled from, or from `old_tree` if `from_hydrated` is False.
+           Statements are executed in `connection`, by default the session."""
+        if connection is None:
+            connection = self.session
+        for tablename, klazz in self.mapped_classes.items():
+            new_id = get_table_tree_id(new_tree, tablename)
+            if self.hydrated is None:
+                old_id = get_table_tree_id(old_tree, tablename)
+            elif tablename in self.hydrated:
+                if from_hydrated:
+                    old_id = Oid(hex=self.hydrated[tablename])
+                else:
+                    old_id = get_table_tree_id(old_tree, tablename)
+            else:
+                continue
+            if old_id != new_id:
+                self.updateTable(klazz, old_id, new_id, connection)
+                if self.hydrated is not None:
+                    connection.execute(hydration_table.update().where(hydration_table.c.tablename == tablename),
+                                       {'tree_id': new_id.hex})
+                    self.hydrated[tablename] = new_id.hex
+    def updateTable(self, klazz, old_id, new_id, connection=None):
+        """Apply the difference between the table trees `old_id` and
+           `new_id` to the table of `klazz`"""
+        tablename = klazz.__tablename__
+        old_sub_tree = self.repo[old_id] if old_id != empty_tree_id else None
+        new_sub_tree = self.repo[new_id] if new_id != empty_tree_id else None
+        codec = TypeManager.get_codec(klazz)
+        old_rows = {}
+        new_rows = {}
+        for filename, old_blob_id, new_blob_id in diff_trees(self.repo, old_sub_tree, new_sub_tree):
+            if not holds_rows(filename):
+                continue
+            logger.debug("Updating %s/%s" % (tablename, filename))
+            if old_blob_id is not None:
+                for text in iter_row_texts(filename, self.repo[old_blob_id].data):
+                    values = codec.parse(text, read_blob=self.readBlob)
+                    old_rows[codec.values_primary_key(values)] = values
+            if new_blob_id is not None:
+                for text in iter_row_texts(filename, self.repo[new_blob_id].data):
+                    values = codec.parse(text, read_blob=self.readBlob)
+                    new_rows[codec.values_primary_key(values)] = values
+        self.applyRowChanges(klazz, old_rows, new_rows, connection)
+    def applyRowChanges(self, klazz, old_rows, new_rows, connection=None):
+        """Apply the difference between the rows `old_rows` and `new_rows`,
+           both dictionaries mapping primary keys to insert values, to the
+           table of `klazz`."""
+        if connection is None:
+            connection = self.session
+        table = klazz.__table__
+        primary_key_columns = list(table.primary_key.columns)
+        def key_params(primary_key):
+            return {'_pk_' + col.name: value for col, value in zip(primary_key_columns, primary_key)}
+        where = sa.and_(*[col == sa.bindparam('_pk_' + col.name) for col in primary_key_columns])
 
-        if self.repo.head_is_unborn:
-            return
-        read_class(self.Base)
+        deleted = [key_params(pk) for pk in old_rows if pk not in new_rows]
+        updated = [dict(values, **key_params(pk)) for pk, values in new_rows.items()
+                   if pk in old_rows and old_rows[pk] != values]
+        inserted = [values for pk, values in new_rows.items() if pk not in old_rows]
+        if deleted:
+            connection.execute(table.delete().where(where), deleted)
+        if updated:
+            connection.execute(table.update().where(where), updated)
+        if inserted:
+            connection.execute(table.insert(), inserted)
+    def loadHydrated(self, connection):
+        """Return a dictionary mapping the names of the tables that have been
+           filled from git to the ids of the trees they have been filled
+           from, or None if the database has no such bookkeeping because
+           all tables have been filled."""
+        if not hydration_table.exists(connection):
+            return None
+        rows = connection.execute(hydration_table.select()).fetchall()
+        return {row.tablename: row.tree_id for row in rows}
+    def startHydrationBookkeeping(self):
+        """Start lazy mode on a database that contains all tables"""
+        hydration_metadata.create_all(self.engine)
+        tree = self.getCurrentTree()
+        self.hydrated = {tablename: get_table_tree_id(tree, tablename).hex
+                         for tablename in self.mapped_classes}
+        if self.hydrated:
+            self.session.execute(hydration_table.insert(),
+                                 [{'tablename': tablename, 'tree_id': tree_id}
+                                  for tablename, tree_id in self.hydrated.items()])
+        self.session.commit()
+    def finishHydration(self):
+        """Fill all tables that have not been filled in lazy mode and drop the
+           bookkeeping, as all tables are filled outside of lazy mode."""
+        tree = self.getCurrentTree()
+        for tablename, klazz in self.mapped_classes.items():
+            if tablename not in self.hydrated:
+                self.hydrateTable(klazz, tree, self.session)
         self.session.commit()
+        hydration_table.drop(self.engine)
+        self.hydrated = None
+    def hydrateTable(self, klazz, tree, connection):
+        """Fill the table of `klazz` from `tree`"""
+        logger.info("Filling table %s", klazz.__tablename__)
+        tree_id = get_table_tree_id(tree, klazz.__tablename__)
+        if tree_id != empty_tree_id:
+            for insert_entries in self.readTable(klazz, self.repo[tree_id]):
+                connection.execute(klazz.__table__.insert(), insert_entries)
+        connection.execute(hydration_table.insert(), {'tablename': klazz.__tablename__,
+                                                      'tree_id': tree_id.hex})
+        self.hydrated[klazz.__tablename__] = tree_id.hex
+    def getCurrentTree(self):
+        commit = self.getCurrentCommit()
+        if commit is None:
+            return self.repo[self.repo.TreeBuilder().write()]
+        return self.repo[commit].tree
+    def before_execute(self, conn, clauseelement, multiparams, params, *args):
+        """Fill the tables used by a statement in lazy mode"""
+        if self.hydrating or isinstance(clauseelement, sa.schema.DDLElement):
+            return
+        self.hydrating = True
+        try:
+            if self.hydrated_stale:
+                self.hydrated = self.loadHydrated(conn)
+                self.hydrated_stale = False
+            tablenames = get_statement_tablenames(clauseelement)
+            if tablenames is None:
+                tablenames = self.mapped_classes.keys()
+            missing = [tablename for tablename in tablenames
+                       if tablename in self.mapped_classes and tablename not in self.hydrated]
+            if missing:
+                tree = self.gitDBSession.git_handler.working_tree
+                with self.gitDBSession.untracked():
+                    for tablename in missing:
+                        self.hydrateTable(self.mapped_classes[tablename], tree, conn)
+        finally:
+            self.hydrating = False
+    def after_rollback(self, session):
+        # Tables filled in the rolled back transaction are empty again
+        self.hydrated_stale = True
+    def after_git_commit(self, tree):
+        """Record the new trees of the filled tables after a commit"""
+        changed = []
+        for tablename, tree_id in self.hydrated.items():
+            new_tree_id = get_table_tree_id(tree, tablename).hex
+            if new_tree_id != tree_id:
+                changed.append({'_tablename': tablename, 'tree_id': new_tree_id})
+                self.hydrated[tablename] = new_tree_id
+        if changed:
+            self.hydrating = True
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(hydration_table.update().where(
+                        hydration_table.c.tablename == sa.bindparam('_tablename')), changed)
+            finally:
+                self.hydrating = False
+    def after_git_sync(self, old_tree, new_tree):
+        """Apply the commits of other writers from `old_tree` to `new_tree`
+           to the database, which reflects `old_tree`"""
+        logger.info("Updating database to commits of other writers")
+        self.hydrating = True
+        try:
+            with self.engine.begin() as connection:
+                self.applyTreeDiff(old_tree, new_tree, connection, from_hydrated=False)
+        finally:
+            self.hydrating = False
+    def refresh(self):
+        """Update the database to the commits of other writers. Must not be
+           called with uncommitted changes in the session."""
+        self.gitDBSession.git_handler.sync()
     def getCurrentCommit(self):
-        out = self.gitCall(['rev-parse', 'HEAD'])
-        return out.split('\n',1)[0].strip()
+        """Return the hex id of the tip of the branch or None if the
+           branch is unborn"""
+        reference = self.repo.references.get('refs/heads/' + self.branch)
+        if reference is None:
+            return None
+        return reference.resolve().target.hex
     def saveCurrentCommit(self):
-        out, err = sp.Popen(['git', 'rev-parse', 'HEAD'], stdout = sp.PIPE, stderr=sp.PIPE, cwd = self.path).communicate()
-        out = out.decode('utf-8', 'ignore')
-        err = err.decode('utf-8', 'ignore')
-        if err:
-            if not 'unknown revision or path not in the working tree' in err:
-                raise sp.CalledProcessError(err)
-        else:
+        commit = self.getCurrentCommit()
+        if commit is not None:
             with open(os.path.join(self.path, 'dbcommit'), 'w') as dbcommit_file:
-                dbcommit_file.write(out.split('\n',1)[0]+'\n')
+                dbcommit_file.write(commit+'\n')
+    def removeCurrentCommit(self):
+        try:
+            os.remove(os.path.join(self.path, 'dbcommit'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    def getSnapshotFilename(self, commit):
+        return os.path.join(self.snapshot_path, '{0}.{1}'.format(self.dbname, commit))
+    def findSnapshot(self, current=None):
+        """Return the commit of the snapshot of the database at the tip of
+           the branch or, if there is none, of the snapshot closest to it.
+           Returns None if there is no snapshot, or if the database at the
+           commit `current` is at least as close."""
+        target = self.getCurrentCommit()
+        if target is None or current == target:
+            return None
+        commits = [filename.rsplit('.', 1)[1]
+                   for filename in glob.glob(self.getSnapshotFilename('*'))]
+        if target in commits:
+            return target
+        best = None
+        best_distance = None if current is None else self.getDistance(current, target)
+        for commit in commits:
+            distance = self.getDistance(commit, target)
+            if distance is not None and (best_distance is None or distance < best_distance):
+                best, best_distance = commit, distance
+        return best
+    def getDistance(self, commit, target):
+        """Return the number of commits between the hex ids commit and
+           target, or None if commit is unknown"""
+        try:
+            ahead, behind = self.repo.ahead_behind(Oid(hex=commit), Oid(hex=target))
+        except (KeyError, ValueError, GitError):
+            return None
+        return ahead + behind
+    def restoreSnapshot(self, commit):
+        """Copy the snapshot of `commit` into the in-memory database"""
+        logger.info("Restoring snapshot of commit %s", commit)
+        self.restoreDatabase(self.getSnapshotFilename(commit))
+    def saveSnapshot(self):
+        """Save the database as snapshot of the current commit. Only the
+           snapshots of branch tips are kept. The snapshot is restored instead
+           of rebuilding the in-memory database on the next start, or when
+           switching to the branch."""
+        commit_id = self.gitDBSession.git_handler.commit_id
+        if commit_id is None:
+            return
+        commit = commit_id.hex
+        makedirs(self.snapshot_path)
+        filename = self.getSnapshotFilename(commit)
+        tmp_filename = filename + '.tmp'
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        self.backupDatabase(tmp_filename)
+        os.rename(tmp_filename, filename)
+        tips = set(self.repo.references[name].resolve().target.hex
+                   for name in self.repo.references if name.startswith('refs/heads/'))
+        for old_filename in glob.glob(self.getSnapshotFilename('*')):
+            if old_filename != filename and old_filename.rsplit('.', 1)[1] not in tips:
+                os.remove(old_filename)
+    def restoreDatabase(self, filename):
+        """Copy the database file `filename` into the in-memory database"""
+        connection = self.engine.raw_connection()
+        try:
+            source = sqlite3.connect('file:{0}?mode=ro'.format(filename), uri=True)
+            try:
+                source.backup(connection.connection)
+            finally:
+                source.close()
+        finally:
+            connection.close()
+    def backupDatabase(self, filename):
+        """Copy the in-memory database to the new database file `filename`"""
+        connection = self.engine.raw_connection()
+        try:
+            destination = sqlite3.connect(filename)
+            try:
+                connection.connection.backup(destination)
+            finally:
+                destination.close()
+        finally:
+            connection.close()
+    def getCacheKey(self):
+        if self.schema_fingerprint is None:
+            self.schema_fingerprint = schema_fingerprint(self.Base.metadata)
+        return self.getCurrentTree().id.hex, self.schema_fingerprint
+    def fetchCachedDatabase(self, databasename):
+        """Use the database of the current tree from the snapshot cache.
+           Returns False if the cache has no such database."""
+        if self.snapshot_cache is None or self.repo.head_is_unborn:
+            return False
+        tree_id, fingerprint = self.getCacheKey()
+        if not self.in_memory:
+            return self.snapshot_cache.fetch(tree_id, fingerprint, databasename)
+        filename = self.snapshot_cache.lookup(tree_id, fingerprint)
+        if filename is None:
+            return False
+        try:
+            self.restoreDatabase(filename)
+        except sqlite3.OperationalError:
+            # evicted in the meantime
+            return False
+        return True
+    def storeCachedDatabase(self, databasename):
+        """Store the freshly built database in the snapshot cache"""
+        if self.snapshot_cache is None or self.repo.head_is_unborn:
+            return
+        tree_id, fingerprint = self.getCacheKey()
+        if self.in_memory:
+            self.snapshot_cache.store(tree_id, fingerprint, self.backupDatabase)
+        else:
+            self.snapshot_cache.store(tree_id, fingerprint, databasename)
+    def relayout(self):
+        """Move the files of all tables to the places given by their current
+           layouts, e.g. after changing the sharding of a table, in a single
+           commit. The rows themselves and the database are not changed.
+           Must not be called with uncommitted changes in the session."""
+        git_handler = self.gitDBSession.git_handler
+        tree = self.getCurrentTree()
+        for tablename, klazz in self.mapped_classes.items():
+            if tablename not in tree:
+                continue
+            layout = get_layout(klazz)
+            codec = TypeManager.get_codec(klazz)
+            old_files = []
+            rows = {}
+            blob_files = {}
+            for filename, blob_id in iter_blobs(self.repo, self.repo[tree[tablename].id], tablename):
+                old_files.append(filename)
+                if not holds_rows(filename):
+                    continue
+                for text in iter_row_texts(filename, self.repo[blob_id].data):
+                    key = codec.parse_key(text)
+                    rows[key] = text
+                    row_filename = layout.get_filename(tablename, key)
+                    for col_name, row_blob_id in codec.blob_ids(text).items():
+                        blob_files[get_blob_filename(row_filename, col_name)] = row_blob_id
+            new_files = layout.dump_table(tablename, rows)
+            for filename in old_files:
+                if filename not in new_files and filename not in blob_files:
+                    git_handler.remove_file(filename)
+            for filename, text in new_files.items():
+                git_handler.write_file(filename, text)
+            for filename, blob_id in blob_files.items():
+                git_handler.write_bytes(filename, self.readBlob(blob_id))
+        git_handler.commit()
+        git_handler.flush()
+    def switchBranch(self, branch):
+        """Continue on `branch`, which is created at the current commit if it
+           does not exist. A snapshot of the database is kept for the branch
+           that is left. The database is restored from the snapshot of the
+           new branch tip, or updated by the tree diff from the closest of
+           the current commit and the snapshots. Must not be called with
+           uncommitted changes in the session."""
+        self.flush()
+        self.session.close()
+        git_handler = self.gitDBSession.git_handler
+        current = git_handler.commit_id
+        self.saveSnapshot()
+        old_tree, new_tree = git_handler.switch_branch(branch)
+        self.branch = branch
+        commit = self.findSnapshot(None if current is None else current.hex)
+        if commit is not None:
+            self.restoreSnapshot(commit)
+            old_tree = self.repo[commit].tree
+            self.hydrated = self.loadHydrated(self.engine)
+        if old_tree.id != new_tree.id:
+            logger.info("Updating database to branch %s", branch)
+            self.hydrating = True
+            try:
+                with self.engine.begin() as connection:
+                    self.applyTreeDiff(old_tree, new_tree, connection)
+            finally:
+                self.hydrating = False
+        git_handler.saveCurrentCommit()
+    def flush(self):
+        """Commit the transactions waiting for a group commit to git. When
+           flush returns, all committed transactions are durable."""
+        self.gitDBSession.flush()
     def gitCall(self, args):
+        """Run the git binary with `args` in the repository. Deprecated,
+           gitdb2 itself only uses libgit2 now."""
+        warnings.warn('GitDBRepo.gitCall is deprecated, use self.repo (pygit2) instead',
+                      DeprecationWarning, stacklevel=2)
         return sp.check_output(['git']+args, cwd = self.path).decode('utf-8', 'ignore')
     def close(self):
         self.gitDBSession.close()
         self.session.close()
+        if self.maintenance is not None:
+            self.maintenance.close()
+        if self.in_memory:
+            self.saveSnapshot()
     @classmethod
-    def init(cls, Base, path):
+    def init(cls, Base, path, **kwargs):
         makedirs(path)
-        sp.check_output(['git', 'init'], cwd=path)
-        return cls(Base, path)
+        init_repository(path)
+        return cls(Base, path, **kwargs)
@@ -1,16 +1,209 @@
 from __future__ import print_function, division, absolute_import
 
 import datetime
+import weakref
 import sqlalchemy as sa
+from sqlalchemy.orm import attributes
 
 class TypeManager(object):
     type_dict = {}
+    codecs = weakref.WeakKeyDictionary()
     @classmethod
     def register_type(cls, sa_type, gitdb_type):
         cls.type_dict[sa_type] = gitdb_type
+        cls.codecs.clear()
+    @classmethod
+    def get_type(cls, sa_type):
+        """Return the gitdb type for an instance of a sqlalchemy type,
+           or None if the type is not supported"""
+        for t in cls.type_dict:
+            if isinstance(sa_type, t):
+                return cls.type_dict[t]
+        return None
+    @classmethod
+    def get_column_type(cls, col):
+        """Return the gitdb type of a column. Text columns with
+           `info={'gitdb_blob': True}` are stored as separate blobs."""
+        if col.info.get('gitdb_blob') and not isinstance(col.type, sa.LargeBinary):
+            return LargeText
+        return cls.get_type(col.type)
+    @classmethod
+    def get_codec(cls, klazz):
+        """Return the `RowCodec` of a mapped class, compiling it on first use"""
+        codec = cls.codecs.get(klazz)
+        if codec is None:
+            codec = cls.codecs[klazz] = RowCodec(klazz)
+        return codec
+
+
+NEVER_SET = getattr(attributes, 'NEVER_SET', attributes.NO_VALUE)
+
+class RowCodec(object):
+    """Converts the rows of a mapped class from and to the file format.
+       Column order, names, types and primary keys are looked up once
+       when the codec is compiled. Codecs hold no reference to the class,
+       so that they can be sent to worker processes."""
+    def __init__(self, klazz):
+        mapper = klazz.__mapper__
+        table = klazz.__table__
+        content_attr = getattr(klazz, '__content__', None)
+        # (attribute name, column key, column name, gitdb type) of all
+        # columns that are written as "name: value" lines, in file order
+        self.fields = []
+        self.content_attr = content_attr
+        self.content_key = None
+        self.primary_key_attrs = []
+        for attr_name, col in mapper.columns.items():
+            if col.primary_key:
+                self.primary_key_attrs.append(attr_name)
+            if attr_name == content_attr:
+                self.content_key = col.key
+                continue
+            self.fields.append((attr_name, col.key, col.name, TypeManager.get_column_type(col)))
+        # fields whose values are stored in blobs of their own. The row
+        # file only holds the ids of these blobs.
+        self.blob_fields = [field for field in self.fields
+                            if field[3] is not None and field[3].blob]
+        # column name in file -> (column key, gitdb type) for parsing
+        self.columns = {col.name: (key, TypeManager.get_column_type(col))
+                        for key, col in table.columns.items()}
+        self.column_keys = list(table.columns.keys())
+        self.primary_key_keys = [col.key for col in table.primary_key.columns]
+        self.primary_key_columns = [(col.name, TypeManager.get_column_type(col))
+                                    for col in table.primary_key.columns]
+
+    def dump(self, obj, blob_ids=None):
+        """Return the file content of a mapped object. `blob_ids` maps
+           the column names of blob columns to the ids of their blobs."""
+        lines = []
+        for attr_name, key, col_name, gitdb_type in self.fields:
+            if blob_ids and col_name in blob_ids:
+                # don't load the value of blob columns, only their ids are dumped
+                lines.append('{0}: {1}\n'.format(col_name, blob_ids[col_name]))
+                continue
+            value = getattr(obj, attr_name)
+            if value is None:
+                continue
+            lines.append(self.dump_line(col_name, gitdb_type, value, blob_ids))
+        if self.content_attr is not None:
+            value = getattr(obj, self.content_attr)
+            if value is not None:
+                lines.append('\n')
+                lines.append(value)
+        return ''.join(lines)
+
+    def dump_values(self, values, blob_ids=None):
+        """Return the file content of a row given as dictionary of column
+           keys to values"""
+        lines = []
+        for attr_name, key, col_name, gitdb_type in self.fields:
+            value = values.get(key)
+            if value is None:
+                continue
+            lines.append(self.dump_line(col_name, gitdb_type, value, blob_ids))
+        if self.content_key is not None:
+            value = values.get(self.content_key)
+            if value is not None:
+                lines.append('\n')
+                lines.append(value)
+        return ''.join(lines)
+
+    @staticmethod
+    def dump_line(col_name, gitdb_type, value, blob_ids):
+        if gitdb_type is None:
+            raise TypeError('Unsupported type of column {0}'.format(col_name))
+        if gitdb_type.blob:
+            if not blob_ids or col_name not in blob_ids:
+                raise ValueError('No blob id for column {0}'.format(col_name))
+            value_str = blob_ids[col_name]
+        else:
+            value_str = gitdb_type.to_string(value)
+        return '{0}: {1}\n'.format(col_name, value_str)
+
+    def parse_key(self, data):
+        """Return the primary key of file content as used in filenames,
+           without parsing other columns"""
+        lines = {}
+        for line in data.split('\n\n', 1)[0].split('\n'):
+            if line:
+                name, value = line.split(': ', 1)
+                lines[name] = value
+        return ','.join([str(gitdb_type.from_string(lines[name]))
+                         for name, gitdb_type in self.primary_key_columns])
+
+    def blob_ids(self, data):
+        """Return the blob ids of the blob columns in file content
+           by column name"""
+        blob_ids = {}
+        blob_names = set(field[2] for field in self.blob_fields)
+        for line in data.split('\n\n', 1)[0].split('\n'):
+            if line:
+                name, value = line.split(': ', 1)
+                if name in blob_names:
+                    blob_ids[name] = value
+        return blob_ids
+
+    def parse(self, data, fill=True, read_blob=None):
+        """Parse file content into a dictionary of insert values. With
+           `fill`, columns missing in the file are set to None. The values
+           of blob columns are read with `read_blob(blob_id)`."""
+        values = {}
+        parts = data.split('\n\n', 1)
+        if len(parts) > 1:
+            meta, content = parts
+        else:
+            meta, content = parts[0], None
+        columns = self.columns
+        for line in meta.split('\n'):
+            if line:
+                name, value = line.split(': ', 1)
+                column = columns.get(name)
+                if column is not None:
+                    key, gitdb_type = column
+                    if gitdb_type is None:
+                        raise TypeError('Unsupported type of column {0}'.format(name))
+                    if gitdb_type.blob:
+                        if read_blob is None:
+                            raise ValueError('Cannot read blob of column {0}'.format(name))
+                        values[key] = gitdb_type.from_bytes(read_blob(value))
+                    else:
+                        values[key] = gitdb_type.from_string(value)
+        if content is not None and self.content_key is not None:
+            values[self.content_key] = content
+        if fill:
+            for key in self.column_keys:
+                if key not in values:
+                    values[key] = None
+        return values
+
+    def primary_key(self, obj):
+        """Return the primary key of a mapped object as used in filenames"""
+        return ','.join([str(getattr(obj, attr_name)) for attr_name in self.primary_key_attrs])
+
+    def old_primary_key(self, obj):
+        """Return the primary key a mapped object had before its
+           pending changes, as used in filenames"""
+        committed_state = attributes.instance_state(obj).committed_state
+        keys = []
+        for attr_name in self.primary_key_attrs:
+            value = committed_state.get(attr_name)
+            if value is None or value is attributes.NO_VALUE or value is NEVER_SET:
+                value = getattr(obj, attr_name)
+            keys.append(str(value))
+        return ','.join(keys)
+
+    def values_primary_key(self, values):
+        """Return the primary key of insert values as tuple"""
+        return tuple([values[key] for key in self.primary_key_keys])
+
+    def values_filename_key(self, values):
+        """Return the primary key of insert values as used in filenames"""
+        return ','.join([str(values[key]) for key in self.primary_key_keys])
 
 
 class AbstractType(object):
+    # wether values are stored as blobs of their own instead of in the row file
+    blob = False
     @staticmethod
     def to_string(self, value):
         raise NotImplementedError()
@@ -70,3 +263,23 @@ class Bool(AbstractType):
         else:
             raise ValueError('Invalid value for type Boolean: {0}'.format(value))
 TypeManager.register_type(sa.Boolean, Bool)
+
+class LargeBinary(AbstractType):
+    blob = True
+    @staticmethod
+    def to_bytes(value):
+        return bytes(value)
+    @staticmethod
+    def from_bytes(data):
+        return data
+TypeManager.register_type(sa.LargeBinary, LargeBinary)
+
+class LargeText(AbstractType):
+    """Text columns with `info={'gitdb_blob': True}`"""
+    blob = True
+    @staticmethod
+    def to_bytes(value):
+        return value.encode('utf-8')
+    @staticmethod
+    def from_bytes(data):
+        return data.decode('utf-8')
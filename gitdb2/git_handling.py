@@ -4,18 +4,75 @@ from __future__ import print_function, division, absolute_import, \
 from six import text_type
 
 import os
-import codecs
 import errno
+import time
+import threading
+from contextlib import contextmanager
 
-from boltons.fileutils import mkdir_p
 
 from pygit2 import Repository, GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE, \
-    Signature, Oid
+    Signature, Oid, IndexEntry
 from pygit2 import hash as git_hash
 
+from .object_writers import LooseObjectWriter, PackObjectWriter
+from .layouts import is_bucket_filename, parse_bucket, dump_bucket
+from .working_copy import WorkingCopy, ThreadedWorkingCopy
+
+try:
+    import fcntl
+except ImportError:
+    # no locking between processes
+    fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
+
 empty_tree_id = Oid(hex='4b825dc642cb6eb9a060e54bf8d69288fbee4904')
 
 
+class ConflictError(Exception):
+    """Raised when the changes of a commit cannot be rebased onto the
+    commits of another writer. `conflicts` lists the conflicting files,
+    and "bucket:key" for conflicting rows of packed tables."""
+    def __init__(self, conflicts):
+        super(ConflictError, self).__init__(
+            'Changed by another writer: {}'.format(', '.join(conflicts)))
+        self.conflicts = conflicts
+
+
+@contextmanager
+def repository_lock(git_dir):
+    """Lock the repository against commits of other processes"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(git_dir, 'gitdb2.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class TransactionState(object):
+    """Holds the current transaction of a `GitHandler` that is not
+    threadsafe, in place of a `threading.local`"""
+
+
+class RepositoryPool(object):
+    """Hands out a repository handle per thread, as libgit2 repositories
+    must not be used by several threads at once"""
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.local = threading.local()
+
+    def get(self):
+        repo = getattr(self.local, 'repo', None)
+        if repo is None:
+            repo = self.local.repo = Repository(self.repo_path)
+        return repo
+
+
 def makedirs(dirname):
     """Creates the directories for dirname via os.makedirs, but does not raise
        an exception if the directory already exists and passes if dirname="".
@@ -29,21 +86,6 @@ def makedirs(dirname):
             raise
 
 
-def remove_file_with_empty_parents(root, filename):
-    """Remove root/filename, also removing any empty parents
-       up to (but excluding) root"""
-    root = os.path.normpath(root)
-    full_filename = os.path.join(root, filename)
-    if os.path.isfile(full_filename):
-        os.remove(full_filename)
-    parent = os.path.normpath(os.path.dirname(full_filename))
-    while parent != root:
-        if os.listdir(parent):
-            break
-        os.rmdir(parent)
-        parent = os.path.normpath(os.path.dirname(parent))
-
-
 def full_split(filename):
     head, tail = os.path.split(filename)
     parts = [tail]
@@ -163,25 +205,189 @@ def get_tree_entry(repo, tree, filename):
         return get_tree_entry(repo, sub_tree, sub_filename)
 
 
+def iter_blobs(repo, tree, prefix=''):
+    """Yield (filename, blob_id) for all blobs in tree and its subtrees,
+    in tree order."""
+    for tree_entry in tree:
+        filename = os.path.join(prefix, tree_entry.name)
+        if tree_entry.filemode == GIT_FILEMODE_TREE:
+            for item in iter_blobs(repo, repo[tree_entry.id], filename):
+                yield item
+        else:
+            yield filename, tree_entry.id
+
+
+def diff_trees(repo, old_tree, new_tree, prefix=''):
+    """Yield (filename, old_blob_id, new_blob_id) for every blob that differs
+    between old_tree and new_tree. Either tree may be None, and either id is
+    None if the file does not exist in the respective tree. Subtrees with
+    identical ids are skipped without being read."""
+    old_entries = {} if old_tree is None else {e.name: e for e in old_tree}
+    new_entries = {} if new_tree is None else {e.name: e for e in new_tree}
+    for name in sorted(set(old_entries) | set(new_entries)):
+        old_entry = old_entries.get(name)
+        new_entry = new_entries.get(name)
+        if old_entry is not None and new_entry is not None and \
+                old_entry.id == new_entry.id and \
+                old_entry.filemode == new_entry.filemode:
+            continue
+        filename = os.path.join(prefix, name)
+        old_sub_tree = old_blob_id = None
+        new_sub_tree = new_blob_id = None
+        if old_entry is not None:
+            if old_entry.filemode == GIT_FILEMODE_TREE:
+                old_sub_tree = repo[old_entry.id]
+            else:
+                old_blob_id = old_entry.id
+        if new_entry is not None:
+            if new_entry.filemode == GIT_FILEMODE_TREE:
+                new_sub_tree = repo[new_entry.id]
+            else:
+                new_blob_id = new_entry.id
+        if old_sub_tree is not None or new_sub_tree is not None:
+            for item in diff_trees(repo, old_sub_tree, new_sub_tree, filename):
+                yield item
+        if old_blob_id is not None or new_blob_id is not None:
+            yield filename, old_blob_id, new_blob_id
+
+
+class TreeIndex(object):
+    """In-memory mirror of a tree as path -> (oid, filemode) per directory.
+    Directories are read from the repository on first access and stay
+    valid across commits: `apply` changes the mirrored directories in place
+    and only serializes the directories that changed, so unchanged trees
+    are never read again."""
+    def __init__(self, repo, tree):
+        self.repo = repo
+        self.tree = tree
+        # directory path -> {name: (oid, filemode)}, '' for the root tree
+        self.directories = {}
+
+    def get_directory(self, directory):
+        """Return the entries of directory, which are empty if the
+        directory does not exist"""
+        entries = self.directories.get(directory)
+        if entries is None:
+            if not directory:
+                tree = self.tree
+            else:
+                parent, name = os.path.split(directory)
+                entry = self.get_directory(parent).get(name)
+                if entry is None or entry[1] != GIT_FILEMODE_TREE:
+                    tree = None
+                else:
+                    tree = self.repo[entry[0]]
+            if tree is None:
+                entries = {}
+            else:
+                entries = {e.name: (e.id, e.filemode) for e in tree}
+            self.directories[directory] = entries
+        return entries
+
+    def get(self, filename):
+        """Return (oid, filemode) of filename or None if it does not exist"""
+        directory, name = os.path.split(filename)
+        return self.get_directory(directory).get(name)
+
+    def get_id(self, filename):
+        entry = self.get(filename)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def apply(self, changes, writer):
+        """Apply changes, a dictionary of filename -> blob_id or None for
+        removed files, and write the changed trees with writer.
+        Directories that become empty are removed. Returns the id of the
+        new root tree."""
+        dirty = set()
+        try:
+            for filename, blob_id in changes.items():
+                directory, name = os.path.split(filename)
+                entries = self.get_directory(directory)
+                if blob_id is None:
+                    if name not in entries:
+                        continue
+                    del entries[name]
+                else:
+                    entries[name] = (blob_id, GIT_FILEMODE_BLOB)
+                while directory not in dirty:
+                    dirty.add(directory)
+                    if not directory:
+                        break
+                    directory = os.path.dirname(directory)
+            if not dirty:
+                return self.tree.id
+            # write the deepest directories first, as their parents
+            # need their new ids
+            for directory in sorted(dirty, key=lambda d: d.count('/') if d else -1,
+                                    reverse=True):
+                entries = self.directories[directory]
+                if not directory:
+                    return writer.write_tree(entries)
+                parent, name = os.path.split(directory)
+                parent_entries = self.get_directory(parent)
+                if entries:
+                    parent_entries[name] = (writer.write_tree(entries), GIT_FILEMODE_TREE)
+                else:
+                    parent_entries.pop(name, None)
+        except:
+            # the mirror is in an unknown state
+            self.directories = {}
+            raise
+
+
 class TreeModifier(object):
     """handles tree modifications of possible large scale"""
-    def __init__(self, repo, tree):
+    def __init__(self, repo, tree, index=None, writer=None, base=None):
         self.repo = repo
         self.tree = tree
+        if index is None:
+            index = TreeIndex(repo, tree)
+        self.index = index
+        # filename -> blob_id or None of the applied operations
+        self.changes = None
+        if writer is None:
+            writer = LooseObjectWriter(repo)
+        self.writer = writer
         self.operations = []
+        # blob ids of files touched by the pending operations,
+        # None for removed files
+        self.pending = {}
+        # function returning the blob id of a file before the operations,
+        # by default the id in the index
+        self.base = base
 
     def insert_blob(self, blob_id, filename):
         self.operations.append(('insert', (blob_id, filename)))
+        self.pending[filename] = blob_id
 
     def remove_blob(self, filename):
         self.operations.append(('remove', (filename, )))
+        self.pending[filename] = None
 
     def move(self, old_filename, new_filename):
         self.operations.append(('move', (old_filename, new_filename)))
+        self.pending[new_filename] = self.get_blob_id(old_filename)
+        self.pending[old_filename] = None
 
-    def simplify(self):
-        """Convert list of operations into nested dictionaries of
-           blob_ids to insert/remove by directory
+    def get_blob_id(self, filename):
+        """Return the id of filename after the pending operations,
+           or None if it does not exist"""
+        if filename in self.pending:
+            return self.pending[filename]
+        if self.base is not None:
+            return self.base(filename)
+        return self.index.get_id(filename)
+
+    def extend(self, other):
+        """Append the operations of the modifier other"""
+        self.operations.extend(other.operations)
+        self.pending.update(other.pending)
+
+    def collect(self):
+        """Convert list of operations into a dictionary of filenames to
+           the blob_ids to insert, or None for files to remove
         """
         todo = {}
         for operation, args in self.operations:
@@ -199,8 +405,7 @@ class TreeModifier(object):
                         raise Exception('Trying to move deleted file',
                                         old_filename, new_filename)
                 else:
-                    blob_id = get_tree_entry(self.repo, self.tree,
-                                             old_filename)
+                    blob_id = self.index.get_id(old_filename)
                     if blob_id is None:
                         raise Exception('Trying to move non existant file',
                                         old_filename, new_filename)
@@ -208,63 +413,46 @@ class TreeModifier(object):
                 todo[new_filename] = blob_id
             else:
                 raise ValueError(operation)
+        return todo
 
-        todo_by_directory = {}
-        for filename, blob_id in todo.items():
-            parts = full_split(filename)
-            directories = parts[:-1]
-            filename = parts[-1]
-            directory = todo_by_directory
-            for d in directories:
-                directory = directory.setdefault(d, {})
-                assert isinstance(directory, dict)
-            directory[filename] = blob_id
-
-        return todo_by_directory
-
-    def update_tree(self, repo, tree, todo):
-        """Apply nested list of new blob_ids from `simplify` to a tree
-        """
-        if tree is None:
-            tree_builder = repo.TreeBuilder()
-        else:
-            tree_builder = repo.TreeBuilder(tree)
-
-        for key, value in todo.items():
-            if value is None:
-                # Remove
-                tree_builder.remove(key)
-            elif isinstance(value, dict):
-                # subdirectory
-                sub_tree_entry = tree_builder.get(key)
-                if not sub_tree_entry:
-                    sub_tree = None
-                else:
-                    sub_tree = repo[sub_tree_entry.id]
-
-                new_subtree_id = self.update_tree(repo, sub_tree, value)
-                tree_builder.insert(key, new_subtree_id, GIT_FILEMODE_TREE)
-            else:
-                # Blob
-                tree_builder.insert(key, value, GIT_FILEMODE_BLOB)
-        new_tree_id = tree_builder.write()
-        return new_tree_id
-
-    def apply(self):
-        todo = self.simplify()
-        new_tree_id = self.update_tree(self.repo, self.tree, todo)
+    def apply(self, changes=None, writer=None):
+        if changes is None:
+            changes = self.collect()
+        if writer is None:
+            writer = self.writer
+        self.changes = changes
+        new_tree_id = self.index.apply(self.changes, writer)
+        writer.flush()
         new_tree = self.repo[new_tree_id]
+        self.index.tree = new_tree
         return new_tree
 
 
 class GitHandler(object):
-    def __init__(self, path, repo_path=None, update_working_copy=True):
+    def __init__(self, path, repo_path=None, update_working_copy=True,
+                 pack_objects=False, maintenance=None, working_copy_workers=0,
+                 group_commit=None, branch='master', threadsafe=False):
         """
         Start a git handler in given repository.
+        `branch`: the branch that is read and committed to.
+        `threadsafe`: if set, every thread has a transaction of its own and
+            uses a repository handle of its own. Transactions are ended in
+            the order they started to change files, which is the order of
+            their SQL commits.
         `update_working_copy`: wether also to update the working copy.
             By default, the git handler will only work on the git database.
             Updating the working copy can take a lot of time in
             large repositories.
+        `pack_objects`: if set, the blobs and trees of a commit are written
+            as one packfile instead of as loose objects.
+        `maintenance`: a `RepositoryMaintenance` that is notified after
+            every commit.
+        `working_copy_workers`: if larger than 0, the working copy is
+            updated by this number of threads. Commits wait until the
+            working copy is up to date.
+        `group_commit`: a `GroupCommitPolicy`. If set, `commit` only ends
+            the transaction, and the ended transactions are committed to
+            git together when the policy says so or on `flush`.
         """
         self.path = path
         if repo_path is None:
@@ -272,106 +460,587 @@ class GitHandler(object):
         self.repo_path = repo_path
         self.update_working_copy = update_working_copy
         self.repo = Repository(self.repo_path)
+        self.ref = 'refs/heads/' + branch
+        if self.repo.is_bare or not self.update_working_copy:
+            self.working_copy = None
+        elif working_copy_workers > 0:
+            self.working_copy = ThreadedWorkingCopy(self.path, working_copy_workers)
+        else:
+            self.working_copy = WorkingCopy(self.path)
         self.working_tree = self.get_last_tree()
-        self.tree_modifier = TreeModifier(self.repo, self.working_tree)
-        self.messages = []
+        # id of the commit of the working tree, None if the branch is unborn
+        self.commit_id = self.getCurrentCommit()
+        self.tree_index = TreeIndex(self.repo, self.working_tree)
+        # id of the tree the index is known to match
+        self.index_tree_id = None
+        self.pack_objects = pack_objects
+        self.threadsafe = threadsafe
+        if threadsafe:
+            self.local = threading.local()
+            self.repos = RepositoryPool(self.repo_path)
+        else:
+            self.local = TransactionState()
+            self.repos = None
+        # guards the state shared by all transactions
+        self.lock = threading.RLock()
+        # commit order of the transactions in threadsafe mode
+        self.order = threading.Condition()
+        self.next_ticket = 0
+        self.turn = 0
+        self.finished = set()
+        # operations of ended transactions that are not committed to git yet
+        self.tree_modifier = self.new_tree_modifier()
+        # messages of the ended transactions
+        self.transactions = []
+        # called with the new tree after each commit
+        self.commit_callbacks = []
+        # trees of commits made by the timer thread whose commit callbacks
+        # have not been called yet
+        self.deferred_trees = []
+        # called with the old and the new tree after moving to commits of
+        # other writers
+        self.sync_callbacks = []
+        self.maintenance = maintenance
+        self.group_commit = group_commit
+        # time the oldest ended transaction has been ended
+        self.first_ended = None
+        self.timer = None
         print("Started libgit2 git handler in ", self.path)
 
+    @property
+    def object_writer(self):
+        """The object writer of the current transaction"""
+        writer = getattr(self.local, 'object_writer', None)
+        if writer is None:
+            repo = self.repo if self.repos is None else self.repos.get()
+            if self.pack_objects:
+                writer = PackObjectWriter(repo)
+            else:
+                writer = LooseObjectWriter(repo)
+            self.local.object_writer = writer
+        return writer
+
+    @property
+    def stage(self):
+        """The operations of the current transaction"""
+        stage = getattr(self.local, 'stage', None)
+        if stage is None:
+            stage = self.local.stage = self.new_stage()
+        return stage
+
+    @stage.setter
+    def stage(self, stage):
+        self.local.stage = stage
+
+    @property
+    def messages(self):
+        """The commit message lines of the current transaction"""
+        messages = getattr(self.local, 'messages', None)
+        if messages is None:
+            messages = self.local.messages = []
+        return messages
+
+    @messages.setter
+    def messages(self, messages):
+        self.local.messages = messages
+
+    def begin_transaction(self):
+        """Take the place of the current transaction in the commit order.
+        Called on its first change, while the database is locked for it."""
+        if not self.threadsafe or getattr(self.local, 'ticket', None) is not None:
+            return
+        with self.order:
+            self.local.ticket = self.next_ticket
+            self.next_ticket += 1
+
+    def wait_for_turn(self):
+        """Wait until the transactions before the current one have ended"""
+        ticket = getattr(self.local, 'ticket', None)
+        if ticket is None:
+            return
+        with self.order:
+            while self.turn != ticket:
+                self.order.wait()
+
+    def finish_transaction(self):
+        """Give up the place of the current transaction in the commit order"""
+        ticket = getattr(self.local, 'ticket', None)
+        if ticket is None:
+            return
+        self.local.ticket = None
+        with self.order:
+            self.finished.add(ticket)
+            while self.turn in self.finished:
+                self.finished.remove(self.turn)
+                self.turn += 1
+            self.order.notify_all()
+
     def get_last_tree(self):
-        if self.repo.head_is_unborn:
+        commit_id = self.getCurrentCommit()
+        if commit_id is None:
             tree_id = self.repo.TreeBuilder().write()
             return self.repo[tree_id]
-        commit = self.repo[self.getCurrentCommit()]
-        return commit.tree
+        return self.repo[commit_id].tree
 
     def insert_into_working_tree(self, blob_id, filename):
-        self.tree_modifier.insert_blob(blob_id, filename)
+        self.stage.insert_blob(blob_id, filename)
 
     def remove_from_working_tree(self, filename):
-        self.tree_modifier.remove_blob(filename)
+        self.stage.remove_blob(filename)
 
     def write_file(self, filename, content):
         # TODO: combine writing many files
         assert isinstance(content, text_type)
-        data = content.encode('utf-8')
-        existing_entry = get_tree_entry(self.repo, self.working_tree, filename)
-        if existing_entry:
+        return self.write_bytes(filename, content.encode('utf-8'))
+
+    def write_bytes(self, filename, data):
+        """Write data to filename and return the id of its blob"""
+        self.begin_transaction()
+        existing_id = self.get_blob_id(filename)
+        if existing_id is not None:
             type = 'M'
-            if existing_entry.id == git_hash(data):
-                return
+            if existing_id == git_hash(data):
+                return existing_id
         else:
             type = 'A'
-        blob_id = self.repo.create_blob(data)
+        blob_id = self.object_writer.write_blob(data)
         self.insert_into_working_tree(blob_id, filename)
 
-        if not self.repo.is_bare and self.update_working_copy:
-            real_filename = os.path.join(self.path, filename)
-            mkdir_p(os.path.dirname(real_filename))
-            with codecs.open(real_filename, 'w', encoding='utf-8') as outfile:
-                outfile.write(content)
+        if self.working_copy is not None:
+            self.working_copy.write(filename, data)
 
         self.messages.append('    {}  {}'.format(type, filename))
+        return blob_id
+
+    def read_blob(self, blob_id):
+        """Return the content of a blob, which may not be written yet"""
+        return self.object_writer.read(blob_id)
+
+    def get_blob_id(self, filename):
+        """Return the blob id of filename including uncommitted changes,
+           or None if the file does not exist"""
+        return self.stage.get_blob_id(filename)
 
     def remove_file(self, filename):
-        existing_entry = get_tree_entry(self.repo, self.working_tree, filename)
-        if existing_entry:
+        self.begin_transaction()
+        if self.get_blob_id(filename) is not None:
             self.remove_from_working_tree(filename)
 
-            if not self.repo.is_bare and self.update_working_copy:
-                remove_file_with_empty_parents(self.path, filename)
+            if self.working_copy is not None:
+                self.working_copy.remove(filename)
 
             self.messages.append('    D  {}'.format(filename))
 
     def move_file(self, old_filename, new_filename):
-        self.tree_modifier.move(old_filename, new_filename)
+        self.begin_transaction()
+        self.stage.move(old_filename, new_filename)
 
-        if not self.repo.is_bare and self.update_working_copy:
-            real_old_filename = os.path.join(self.path, old_filename)
-            real_new_filename = os.path.join(self.path, new_filename)
-            mkdir_p(os.path.dirname(real_new_filename))
-            os.rename(real_old_filename, real_new_filename)
-            remove_file_with_empty_parents(self.path, old_filename)
+        if self.working_copy is not None:
+            blob_id = self.stage.get_blob_id(new_filename)
+            read_data = lambda: self.read_blob(blob_id)
+            self.working_copy.move(old_filename, new_filename, read_data)
 
         self.messages.append('    R  {} -> {}'.format(old_filename,
                                                       new_filename))
 
     def commit(self):
-        if self.tree_modifier.tree.oid != self.get_last_tree().oid:
-            raise Exception("The repository was modified outside of this process. For safety reasons, we cannot commit!")
-        self.working_tree = self.tree_modifier.apply()
-        self.tree_modifier = TreeModifier(self.repo, self.working_tree)
+        """End the current transaction. Its changes are committed to git
+        right away or, with group commit, once the policy says so."""
+        if self.group_commit is None:
+            self.end_transaction()
+            self.flush()
+            return
+        self.run_deferred_callbacks()
+        if not self.stage.operations:
+            self.discard_transaction()
+            return
+        self.end_transaction()
+        with self.lock:
+            if not self.transactions:
+                # committed by another thread meanwhile
+                return
+            age = time.time() - self.first_ended
+            if self.group_commit.is_due(len(self.tree_modifier.operations), age):
+                self.flush()
+            else:
+                self.schedule_flush(age)
+
+    def end_transaction(self):
+        """Move the operations of the current transaction to the operations
+        waiting for the next git commit"""
+        self.wait_for_turn()
+        if self.threadsafe:
+            # other threads may need the blobs of ended transactions
+            self.object_writer.flush()
+        with self.lock:
+            if not self.transactions:
+                self.first_ended = time.time()
+                if self.group_commit is not None:
+                    # the database is ahead of git until the next flush
+                    self.removeCurrentCommit()
+            self.tree_modifier.extend(self.stage)
+            self.transactions.append(self.messages)
+        self.stage = self.new_stage()
+        self.messages = []
+        self.finish_transaction()
+
+    def discard_transaction(self):
+        """Discard the operations of the current transaction, restoring the
+        files it has written in the working copy"""
+        if self.working_copy is not None:
+            for filename in self.stage.pending:
+                blob_id = self.get_ended_blob_id(filename)
+                if blob_id is None:
+                    self.working_copy.remove(filename)
+                else:
+                    self.working_copy.write(filename, self.read_blob(blob_id))
+        self.stage = self.new_stage()
+        self.messages = []
+        self.finish_transaction()
+
+    def schedule_flush(self, age):
+        """Flush from a timer thread once the oldest ended transaction has
+        waited for `max_delay`"""
+        if self.timer is not None or self.group_commit.max_delay is None:
+            return
+        delay = max(self.group_commit.max_delay - age, 0)
+        self.timer = threading.Timer(delay, self.flush_logged)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush_logged(self):
+        try:
+            with self.lock:
+                self.timer = None
+                # rebasing and the commit callbacks update the database,
+                # which is left to the thread of the session
+                self.commit_ended(rebase=False, callbacks=False)
+        except Exception:
+            logger.exception("Group commit failed")
+
+    def get_commit_message(self, changes):
+        """Return the message of a commit of the ended transactions. Several
+        transactions are summarized by the last change of each file."""
+        if len(self.transactions) == 1:
+            return '\n'.join(self.transactions[0])
+        lines = ['Group commit of {} transactions'.format(len(self.transactions)), '']
+        for filename in sorted(changes):
+            existing_id = self.tree_index.get_id(filename)
+            if changes[filename] is None:
+                if existing_id is None:
+                    continue
+                type = 'D'
+            elif existing_id is None:
+                type = 'A'
+            elif existing_id != changes[filename]:
+                type = 'M'
+            else:
+                continue
+            lines.append('    {}  {}'.format(type, filename))
+        return '\n'.join(lines)
+
+    def flush(self):
+        """Commit the ended transactions to git"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.run_deferred_callbacks()
+            self.commit_ended()
+
+    def run_deferred_callbacks(self):
+        """Call the commit callbacks of the commits made by the timer thread
+        and record the commit the database reflects afterwards"""
+        with self.lock:
+            trees, self.deferred_trees = self.deferred_trees, []
+            for tree in trees:
+                for callback in self.commit_callbacks:
+                    callback(tree)
+            if trees and not self.transactions:
+                self.saveCurrentCommit()
+
+    def read_head(self):
+        """Return the commit and the tree id of the tip of the branch"""
+        commit_id = self.getCurrentCommit()
+        if commit_id is None:
+            return None, empty_tree_id
+        head_commit = self.repo[commit_id]
+        return head_commit, head_commit.tree_id
+
+    def commit_ended(self, rebase=True, callbacks=True):
+        """Commit the ended transactions. If HEAD has been moved by another
+        writer, the changes are rebased onto HEAD first, unless `rebase` is
+        False, in which case nothing is committed. Unless `callbacks` is set,
+        the commit callbacks are deferred to `run_deferred_callbacks`."""
+        with repository_lock(self.repo.path):
+            head_commit, head_tree_id = self.read_head()
+            changes = self.tree_modifier.collect()
+            if self.tree_modifier.tree.id != head_tree_id:
+                if not rebase:
+                    return
+                changes = self.rebase(head_commit, self.repo[head_tree_id], changes)
+            self.apply_changes(head_commit, head_tree_id, changes, callbacks)
+
+    def rebase(self, head_commit, head_tree, changes):
+        """Return changes, made on top of the working tree, replayed onto
+        head_tree, and move the working tree to head_tree. Changes of
+        different rows of a bucket file are merged. If a file has been
+        changed differently on both sides, the ended transactions are
+        discarded and `ConflictError` is raised."""
+        old_tree = self.working_tree
+        theirs = dict((filename, new_blob_id) for filename, old_blob_id, new_blob_id
+                      in diff_trees(self.repo, old_tree, head_tree))
+        rebased = {}
+        conflicts = []
+        for filename, blob_id in changes.items():
+            base_id = self.tree_index.get_id(filename)
+            if blob_id == base_id:
+                continue
+            if filename not in theirs:
+                rebased[filename] = blob_id
+                continue
+            their_id = theirs[filename]
+            if their_id == blob_id:
+                continue
+            try:
+                rebased[filename] = self.merge_blobs(filename, base_id, blob_id, their_id)
+            except ConflictError as e:
+                conflicts.extend(e.conflicts)
+        if conflicts:
+            our_tree = self.repo[self.tree_index.apply(changes, self.object_writer)]
+            self.object_writer.flush()
+            self.transactions = []
+            self.move_working_tree(our_tree, head_tree, head_commit)
+            raise ConflictError(conflicts)
+        self.move_working_tree(old_tree, head_tree, head_commit)
+        if self.working_copy is not None:
+            for filename, blob_id in rebased.items():
+                if theirs.get(filename, blob_id) == blob_id:
+                    continue
+                # merged bucket file
+                if blob_id is None:
+                    self.working_copy.remove(filename)
+                else:
+                    self.working_copy.write(filename, self.read_blob(blob_id))
+        return rebased
+
+    def merge_blobs(self, filename, base_id, our_id, their_id):
+        """Merge the rows of a bucket file changed on both sides and return
+        the id of the merged blob. Raises `ConflictError` for other files
+        and for rows changed on both sides."""
+        if not is_bucket_filename(filename):
+            raise ConflictError([filename])
+        def read_rows(blob_id):
+            if blob_id is None:
+                return {}
+            return parse_bucket(self.read_blob(blob_id).decode('utf-8'))
+        base, ours, theirs = read_rows(base_id), read_rows(our_id), read_rows(their_id)
+        merged = {}
+        conflicts = []
+        for key in set(base) | set(ours) | set(theirs):
+            base_text, our_text, their_text = base.get(key), ours.get(key), theirs.get(key)
+            if our_text == base_text:
+                text = their_text
+            elif their_text == base_text or their_text == our_text:
+                text = our_text
+            else:
+                conflicts.append('{0}:{1}'.format(filename, key))
+                continue
+            if text is not None:
+                merged[key] = text
+        if conflicts:
+            raise ConflictError(conflicts)
+        if not merged:
+            return None
+        return self.object_writer.write_blob(dump_bucket(merged).encode('utf-8'))
+
+    def move_working_tree(self, old_tree, new_tree, commit, sync=True):
+        """Continue from new_tree of commit, committed by another writer,
+        updating the working copy and, if `sync` is set, calling the
+        `sync_callbacks`"""
+        self.working_tree = new_tree
+        self.commit_id = None if commit is None else commit.id
+        self.tree_index = TreeIndex(self.repo, new_tree)
+        self.tree_modifier = self.new_tree_modifier()
+        if self.working_copy is not None:
+            self.checkout_changes(old_tree, new_tree)
+        if sync:
+            for callback in self.sync_callbacks:
+                callback(old_tree, new_tree)
+        if not self.transactions:
+            self.saveCurrentCommit()
+
+    def sync(self):
+        """Move to the commits of other writers. Does nothing while
+        transactions are waiting for a group commit."""
+        with self.lock:
+            self.run_deferred_callbacks()
+            if self.transactions:
+                return
+            head_commit, head_tree_id = self.read_head()
+            if head_tree_id != self.working_tree.id:
+                self.move_working_tree(self.working_tree, self.repo[head_tree_id], head_commit)
 
-        if self.repo.head_is_unborn:
+    def switch_branch(self, branch):
+        """Commit the ended transactions and continue on branch, which is
+        created at the current commit if it does not exist. Returns the old
+        and the new tree; updating the database is left to the caller."""
+        with self.lock:
+            self.flush()
+            ref = 'refs/heads/' + branch
+            if ref not in self.repo.references and self.commit_id is not None:
+                self.repo.references.create(ref, self.commit_id)
+            self.ref = ref
+            if self.working_copy is not None:
+                self.repo.set_head(ref)
+            old_tree = self.working_tree
+            head_commit, head_tree_id = self.read_head()
+            new_tree = self.get_last_tree()
+            self.move_working_tree(old_tree, new_tree, head_commit, sync=False)
+            return old_tree, new_tree
+
+    def apply_changes(self, head_commit, head_tree_id, changes, callbacks=True):
+        """Commit changes on top of head_commit"""
+        old_tree = self.working_tree
+        message = self.get_commit_message(changes)
+        self.working_tree = self.tree_modifier.apply(changes, self.object_writer)
+        self.tree_modifier = self.new_tree_modifier()
+        self.transactions = []
+
+        if head_commit is None:
             parents = []
         else:
-            commit = self.repo[self.getCurrentCommit()]
-            if commit.tree.id == self.working_tree.id:
+            if head_tree_id == self.working_tree.id:
+                self.flush_working_copy()
+                if self.group_commit is not None and not self.deferred_trees:
+                    self.saveCurrentCommit()
                 return
-            parents = [commit.id]
+            parents = [head_commit.id]
 
         config = self.repo.config
         author = Signature(config['user.name'], config['user.email'])
         committer = Signature(config['user.name'], config['user.email'])
         tree_id = self.working_tree.id
-        message = '\n'.join(self.messages)
-        self.repo.create_commit('refs/heads/master',
-                                author, committer, message,
-                                tree_id,
-                                parents)
-        self.saveCurrentCommit()
-        self.messages = []
-        if not self.repo.is_bare and self.update_working_copy:
-            self.repo.index.read_tree(self.working_tree)
-            self.repo.index.write()
+        self.commit_id = self.repo.create_commit(self.ref,
+                                                 author, committer, message,
+                                                 tree_id,
+                                                 parents)
+        if callbacks:
+            for callback in self.commit_callbacks:
+                callback(self.working_tree)
+            self.saveCurrentCommit()
+        else:
+            # the database bookkeeping lags behind until the callbacks are
+            # called, so the dbcommit file stays removed
+            self.deferred_trees.append(self.working_tree)
+        if self.working_copy is not None:
+            self.working_copy.flush()
+            self.update_index(old_tree, changes)
+        if self.maintenance is not None:
+            self.maintenance.after_commit(self.working_tree)
+
+    def flush_working_copy(self):
+        """Wait until the working copy matches the working tree"""
+        if self.working_copy is not None:
+            self.working_copy.flush()
+
+    def close(self):
+        with self.lock:
+            self.run_deferred_callbacks()
+            if self.transactions:
+                self.flush()
+            elif self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if self.working_copy is not None:
+            self.working_copy.close()
+
+    def update_index(self, old_tree, changes):
+        """Update the index for the changed files of a commit. The index is
+        only read from the tree completely if it may not match old_tree."""
+        index = self.repo.index
+        if self.index_tree_id != old_tree.id:
+            index.read_tree(self.working_tree)
+        else:
+            for filename, blob_id in changes.items():
+                if blob_id is None:
+                    if filename in index:
+                        index.remove(filename)
+                else:
+                    index.add(IndexEntry(filename, blob_id, GIT_FILEMODE_BLOB))
+        index.write()
+        self.index_tree_id = self.working_tree.id
+
+    def checkout_changes(self, old_tree, new_tree):
+        """Update the working copy and the index from old_tree to new_tree,
+        writing only the files that differ"""
+        index = self.repo.index
+        incremental = self.index_tree_id == old_tree.id
+        for filename, old_blob_id, new_blob_id in diff_trees(self.repo, old_tree, new_tree):
+            if new_blob_id is None:
+                self.working_copy.remove(filename)
+                if incremental and filename in index:
+                    index.remove(filename)
+            else:
+                self.working_copy.write(filename, self.repo[new_blob_id].data)
+                if incremental:
+                    index.add(IndexEntry(filename, new_blob_id, GIT_FILEMODE_BLOB))
+        self.working_copy.flush()
+        if not incremental:
+            index.read_tree(new_tree)
+        index.write()
+        self.index_tree_id = new_tree.id
+
+    def new_tree_modifier(self):
+        return TreeModifier(self.repo, self.working_tree, self.tree_index,
+                            self.object_writer)
+
+    def new_stage(self):
+        return TreeModifier(self.repo, self.working_tree, self.tree_index,
+                            self.object_writer, base=self.get_ended_blob_id)
+
+    def get_ended_blob_id(self, filename):
+        """Return the blob id of filename after the ended transactions"""
+        with self.lock:
+            return self.tree_modifier.get_blob_id(filename)
 
     def reset(self):
-        self.working_tree = self.get_last_tree()
-        self.tree_modifier = TreeModifier(self.repo, self.working_tree)
-        self.messages = []
+        """Discard the current transaction. Ended transactions that wait
+        for a group commit are kept."""
+        self.discard_transaction()
+        with self.lock:
+            self.run_deferred_callbacks()
+            if self.transactions:
+                # the writer still holds the objects of the ended
+                # transactions, the discarded ones are left unreachable
+                return
+            self.object_writer.clear()
+            self.flush_working_copy()
+            if self.tree_index.tree.id != self.working_tree.id:
+                self.tree_index = TreeIndex(self.repo, self.working_tree)
+            self.tree_modifier = self.new_tree_modifier()
+            self.stage = self.new_stage()
+            # HEAD may have been moved outside of this process
+            self.sync()
 
     def getCurrentCommit(self):
-        return self.repo.head.target
+        """Return the id of the tip of the branch, None if it is unborn"""
+        reference = self.repo.references.get(self.ref)
+        if reference is None:
+            return None
+        return reference.resolve().target
 
     def saveCurrentCommit(self):
+        """Record the commit the database reflects"""
+        if self.commit_id is None:
+            self.removeCurrentCommit()
+            return
         with open(os.path.join(self.path, 'dbcommit'), 'w') as dbcommit_file:
-            dbcommit_file.write(self.getCurrentCommit().hex+'\n')
+            dbcommit_file.write(self.commit_id.hex+'\n')
+
+    def removeCurrentCommit(self):
+        try:
+            os.remove(os.path.join(self.path, 'dbcommit'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
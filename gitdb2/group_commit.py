@@ -0,0 +1,44 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+"""
+   Group commit merges consecutive SQL transactions into one git commit.
+
+   Without group commit, every `session.commit()` writes the trees, moves
+   the branch, rewrites the dbcommit file and the index. With
+   `GitDBRepo(..., group_commit=GroupCommitPolicy())`, committed transactions
+   are collected and committed to git together once the oldest of them has
+   waited `max_delay` seconds or they changed `max_operations` files.
+   `GitDBRepo.flush()` commits the collected transactions at once, and so
+   does `GitDBRepo.close()`. A commit made after `max_delay` by the timer
+   thread only writes git; the database bookkeeping of that commit (the
+   dbcommit file, the filled tables in lazy mode) is updated on the next
+   call from the thread of the session.
+
+   Durability: a transaction is durable once its changes are in a git
+   commit. While transactions are waiting, the dbcommit file is removed, so
+   if the process dies before the next git commit, the database is rebuilt
+   from git on the next start and the waiting transactions are lost
+   consistently in both. Call `flush()` where a transaction must be durable,
+   e.g. before reporting success to a client. Rolling back a transaction
+   never discards the waiting transactions before it.
+"""
+
+
+class GroupCommitPolicy(object):
+    """Decides when the collected transactions are committed to git.
+    `max_delay`: seconds a committed transaction may wait for its git
+        commit, or None to wait for `flush` or `max_operations`.
+    `max_operations`: number of file operations after which the collected
+        transactions are committed, or None for no limit.
+    """
+    def __init__(self, max_delay=1.0, max_operations=1000):
+        self.max_delay = max_delay
+        self.max_operations = max_operations
+
+    def is_due(self, operations, age):
+        """Return whether transactions with `operations` file operations,
+        the oldest of which has waited `age` seconds, have to be committed"""
+        if self.max_operations is not None and operations >= self.max_operations:
+            return True
+        return self.max_delay is not None and age >= self.max_delay
@@ -0,0 +1,181 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import os
+import hashlib
+
+"""
+   Layouts decide how the rows of a table are arranged in files.
+
+   By default every row is stored in a file of its own (`RowPerFileLayout`).
+   Tables with many small rows can opt into `PackedLayout` by setting
+   `__layout__ = PackedLayout()` on the mapped class, which stores the rows in
+   a fixed number of bucket files. The rows in the buckets have exactly the
+   same format as the row files, so tables can be converted between layouts
+   without loss. Readers recognize the layout from the filenames, so
+   a repository can be read without knowing the layouts of its tables.
+
+   Row files are spread over directories by a sharding strategy, e.g.
+   `__layout__ = RowPerFileLayout(HashSharding(depth=2))`. After changing the
+   layout of a table, `GitDBRepo.relayout()` moves the existing files.
+"""
+
+
+def get_filename(tablename, primary_key):
+    primary_key_name = str(primary_key)
+    if len(primary_key_name) > 3:
+        prefix = primary_key_name[:2]
+        return '{0}/{1}/{2}.txt'.format(tablename, prefix, primary_key_name)
+    else:
+        return '{0}/{1}.txt'.format(tablename, primary_key_name)
+
+
+def get_blob_filename(filename, col_name):
+    """Return the filename of the blob of column col_name
+       next to the row file filename"""
+    return '{0}.{1}.blob'.format(os.path.splitext(filename)[0], col_name)
+
+
+def is_row_filename(filename):
+    return filename.endswith('.txt')
+
+
+def is_bucket_filename(filename):
+    return filename.endswith('.rows')
+
+
+def holds_rows(filename):
+    """Return whether filename stores rows, as opposed to e.g. blobs of
+       blob columns, which need not be read to load a table"""
+    return is_row_filename(filename) or is_bucket_filename(filename)
+
+
+def dump_bucket(rows):
+    """Return the content of a bucket file storing rows, a dictionary
+       of primary keys to row file contents. Each row is stored as
+       "<key length> <row length>\\n<key><row>\\n", sorted by key."""
+    parts = []
+    for key in sorted(rows):
+        text = rows[key]
+        parts.append('{0} {1}\n{2}{3}\n'.format(len(key), len(text), key, text))
+    return ''.join(parts)
+
+
+def parse_bucket(data):
+    """Return the dictionary of primary keys to row file contents
+       stored in the bucket file content data"""
+    rows = {}
+    position = 0
+    while position < len(data):
+        header_end = data.index('\n', position)
+        key_length, text_length = data[position:header_end].split(' ')
+        key_start = header_end + 1
+        text_start = key_start + int(key_length)
+        text_end = text_start + int(text_length)
+        if data[text_end:text_end + 1] != '\n':
+            raise ValueError('Corrupt bucket file at offset {0}'.format(position))
+        rows[data[key_start:text_start]] = data[text_start:text_end]
+        position = text_end + 1
+    return rows
+
+
+def iter_row_texts(filename, data):
+    """Yield the contents of all rows stored in the file filename with
+       content data, whatever layout the file belongs to"""
+    if is_row_filename(filename):
+        yield data.decode('utf-8')
+    elif is_bucket_filename(filename):
+        for text in parse_bucket(data.decode('utf-8')).values():
+            yield text
+
+
+class PrefixSharding(object):
+    """Shards row files by the first two characters of keys longer than
+       three characters. This is the original layout of gitdb2."""
+    def get_filename(self, tablename, key):
+        return get_filename(tablename, key)
+
+
+class HashSharding(object):
+    """Shards row files into `depth` levels of directories named by
+       `width` hex digits of the hash of the key, e.g. "test/3f/a2/17.txt".
+       Sequential keys are spread evenly over all directories."""
+    def __init__(self, depth=2, width=2):
+        self.depth = depth
+        self.width = width
+
+    def get_filename(self, tablename, key):
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        parts = [tablename]
+        for level in range(self.depth):
+            parts.append(digest[level * self.width:(level + 1) * self.width])
+        parts.append('{0}.txt'.format(key))
+        return '/'.join(parts)
+
+
+class RowPerFileLayout(object):
+    """Stores every row in a file of its own, placed by `sharding`"""
+    def __init__(self, sharding=None):
+        self.sharding = sharding or PrefixSharding()
+
+    def get_filename(self, tablename, key):
+        return self.sharding.get_filename(tablename, key)
+
+    def write_row(self, session, tablename, key, old_key, text):
+        filename = self.get_filename(tablename, key)
+        oldfilename = self.get_filename(tablename, old_key)
+        if oldfilename != filename:
+            session.git_handler.move_file(oldfilename, filename)
+        session.git_handler.write_file(filename, text)
+
+    def delete_row(self, session, tablename, key):
+        session.git_handler.remove_file(self.get_filename(tablename, key))
+
+    def dump_table(self, tablename, rows):
+        """Return a dictionary of filenames to contents storing rows,
+           a dictionary of keys to row file contents"""
+        return {self.get_filename(tablename, key): text for key, text in rows.items()}
+
+
+class PackedLayout(object):
+    """Stores the rows in `buckets` bucket files per table, chosen by the
+       hash of the primary key. Changes are collected by the session and
+       only the affected buckets are rewritten on commit. Blobs of blob
+       columns are placed by `sharding`."""
+    def __init__(self, buckets=256, sharding=None):
+        self.buckets = buckets
+        self.sharding = sharding or PrefixSharding()
+
+    def get_filename(self, tablename, key):
+        """Return the filename a row would have in a file of its own,
+           which is used to place its blobs"""
+        return self.sharding.get_filename(tablename, key)
+
+    def get_bucket_filename(self, tablename, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        bucket = int(digest[:8], 16) % self.buckets
+        return '{0}/{1:04x}.rows'.format(tablename, bucket)
+
+    def write_row(self, session, tablename, key, old_key, text):
+        if old_key != key:
+            self.delete_row(session, tablename, old_key)
+        bucket_filename = self.get_bucket_filename(tablename, key)
+        session.pending_buckets.setdefault(bucket_filename, {})[key] = text
+
+    def delete_row(self, session, tablename, key):
+        bucket_filename = self.get_bucket_filename(tablename, key)
+        session.pending_buckets.setdefault(bucket_filename, {})[key] = None
+
+    def dump_table(self, tablename, rows):
+        buckets = {}
+        for key, text in rows.items():
+            buckets.setdefault(self.get_bucket_filename(tablename, key), {})[key] = text
+        return {filename: dump_bucket(bucket_rows) for filename, bucket_rows in buckets.items()}
+
+
+default_layout = RowPerFileLayout()
+
+
+def get_layout(klazz):
+    """Return the layout of the mapped class klazz"""
+    return getattr(klazz, '__layout__', None) or default_layout
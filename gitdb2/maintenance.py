@@ -0,0 +1,258 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import os
+import glob
+import errno
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from pygit2 import Repository, PackBuilder, Oid, GIT_FILEMODE_TREE, \
+    GIT_SORT_NONE, Commit, Tag, Tree
+
+import logging
+logger = logging.getLogger(__name__)
+
+"""
+   Every commit of gitdb2 leaves loose objects behind, and rolled back
+   transactions leave blobs that are not referenced by any commit. Both slow
+   down object lookups over time. `RepositoryMaintenance` estimates the
+   number of loose objects after each commit and, once a threshold is
+   crossed, packs the reachable loose objects and prunes unreachable ones
+   in a background thread, like `git gc --auto` does.
+
+   With `pack_objects=True`, every commit writes a packfile instead of loose
+   objects. Once there are more than `pack_threshold` packs, all reachable
+   objects are rewritten into a single pack and the old packs are removed,
+   like `gc.autoPackLimit` of git. Objects of packs younger than
+   `prune_grace` are kept even if they are unreachable.
+"""
+
+
+def iter_loose_objects(objects_dir):
+    """Yield (oid, filename) of all loose objects in objects_dir"""
+    for directory in os.listdir(objects_dir):
+        if len(directory) != 2:
+            continue
+        path = os.path.join(objects_dir, directory)
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        for name in names:
+            if len(name) == 38:
+                yield Oid(hex=directory + name), os.path.join(path, name)
+
+
+def read_pack_index(filename):
+    """Return the ids of the objects in the pack with the index filename"""
+    with open(filename, 'rb') as index_file:
+        data = index_file.read()
+    if data[:4] == b'\xfftOc':
+        # version 2: header, fanout table, object ids
+        count = struct.unpack('>I', data[8 + 255 * 4:8 + 256 * 4])[0]
+        offset = 8 + 256 * 4
+        return [Oid(raw=data[offset + 20 * i:offset + 20 * (i + 1)]) for i in range(count)]
+    # version 1: fanout table, then offset and id of every object
+    count = struct.unpack('>I', data[255 * 4:256 * 4])[0]
+    offset = 256 * 4
+    return [Oid(raw=data[offset + 24 * i + 4:offset + 24 * (i + 1)]) for i in range(count)]
+
+
+class RepositoryMaintenance(object):
+    """Packs and prunes the loose objects of the repository in `repo_path`.
+    `loose_threshold`: approximate number of loose objects above which
+        maintenance is started.
+    `pack_threshold`: number of packs above which maintenance is started
+        and all packs are consolidated into one.
+    `prune_grace`: unreachable loose objects younger than this number of
+        seconds are kept, as they may belong to a transaction in progress.
+    `background`: run the maintenance in a thread instead of in the
+        committing thread.
+    """
+    def __init__(self, repo_path, loose_threshold=6700, prune_grace=2*7*24*3600,
+                 background=True, pack_threshold=50):
+        self.repo_path = repo_path
+        self.objects_dir = os.path.join(Repository(repo_path).path, 'objects')
+        self.pack_dir = os.path.join(self.objects_dir, 'pack')
+        self.loose_threshold = loose_threshold
+        self.pack_threshold = pack_threshold
+        self.prune_grace = prune_grace
+        self.background = background
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_result = None
+
+    def estimate_loose_objects(self):
+        """Estimate the number of loose objects from one of the 256
+        object directories, as git does"""
+        sample_dir = os.path.join(self.objects_dir, '17')
+        try:
+            return 256 * len([name for name in os.listdir(sample_dir) if len(name) == 38])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def list_packs(self):
+        """Return the index filenames of all packs"""
+        return glob.glob(os.path.join(self.pack_dir, 'pack-*.idx'))
+
+    def needs_maintenance(self):
+        return self.estimate_loose_objects() > self.loose_threshold or \
+            len(self.list_packs()) > self.pack_threshold
+
+    def after_commit(self, tree=None):
+        """Start the maintenance if there are too many loose objects.
+        Called by `GitHandler` after every commit."""
+        if self.is_running() or not self.needs_maintenance():
+            return
+        self.start()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.background:
+            self.run()
+            return
+        with self.lock:
+            if self.is_running():
+                return
+            self.thread = threading.Thread(target=self.run_logged, name='gitdb2-maintenance')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run_logged(self):
+        try:
+            self.run()
+        except Exception:
+            logger.exception("Repository maintenance failed")
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def close(self):
+        self.join()
+
+    def find_reachable(self, repo):
+        """Return the ids of all objects reachable from the references"""
+        reachable = set()
+        def add_tree(tree_id):
+            if tree_id in reachable:
+                return
+            reachable.add(tree_id)
+            for entry in repo[tree_id]:
+                if entry.filemode == GIT_FILEMODE_TREE:
+                    add_tree(entry.id)
+                else:
+                    reachable.add(entry.id)
+        targets = []
+        for reference_name in repo.references:
+            target = repo.references[reference_name].resolve().target
+            targets.append(target)
+        if not repo.head_is_unborn:
+            targets.append(repo.head.target)
+        for target in targets:
+            target_object = repo[target]
+            while isinstance(target_object, Tag):
+                reachable.add(target_object.id)
+                target_object = repo[target_object.target]
+            if isinstance(target_object, Tree):
+                add_tree(target_object.id)
+                continue
+            if not isinstance(target_object, Commit):
+                reachable.add(target_object.id)
+                continue
+            target = target_object.id
+            for commit in repo.walk(target, GIT_SORT_NONE):
+                if commit.id in reachable:
+                    continue
+                reachable.add(commit.id)
+                add_tree(commit.tree_id)
+        return reachable
+
+    def write_pack(self, repo, oids):
+        """Write the objects oids as one pack and return the filename of
+        its index"""
+        tmp_dir = tempfile.mkdtemp(dir=self.pack_dir)
+        try:
+            pack_builder = PackBuilder(repo)
+            for oid in oids:
+                pack_builder.add(oid)
+            pack_builder.write(tmp_dir)
+            # the pack has to exist before its index is found
+            for name in sorted(os.listdir(tmp_dir), key=lambda name: name.endswith('.idx')):
+                os.rename(os.path.join(tmp_dir, name), os.path.join(self.pack_dir, name))
+                if name.endswith('.idx'):
+                    index_filename = os.path.join(self.pack_dir, name)
+        finally:
+            shutil.rmtree(tmp_dir)
+        return index_filename
+
+    def run(self):
+        """Pack all reachable loose objects and remove unreachable loose
+        objects older than `prune_grace`. With more than `pack_threshold`
+        packs, the existing packs are consolidated with them. Returns the
+        numbers of packed and pruned loose objects."""
+        start = time.time()
+        repo = Repository(self.repo_path)
+        expire = start - self.prune_grace
+        # packs written from now on are kept
+        old_packs = self.list_packs()
+        loose_objects = list(iter_loose_objects(self.objects_dir))
+        reachable = self.find_reachable(repo)
+        packed = [(oid, filename) for oid, filename in loose_objects if oid in reachable]
+        consolidate = len(old_packs) > self.pack_threshold
+        if consolidate:
+            kept = set(reachable)
+            for index_filename in old_packs:
+                if os.path.getmtime(index_filename) >= expire:
+                    kept.update(read_pack_index(index_filename))
+            new_pack = self.write_pack(repo, kept)
+            for index_filename in old_packs:
+                if index_filename == new_pack:
+                    # the consolidated pack has the content of an old one
+                    continue
+                for filename in [index_filename[:-len('.idx')] + '.pack', index_filename]:
+                    try:
+                        os.remove(filename)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+        elif packed:
+            pack_builder = PackBuilder(repo)
+            for oid, filename in packed:
+                pack_builder.add(oid)
+            pack_builder.write()
+            for oid, filename in packed:
+                try:
+                    os.remove(filename)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        pruned = 0
+        for oid, filename in loose_objects:
+            if oid in reachable:
+                continue
+            try:
+                if os.path.getmtime(filename) >= expire:
+                    continue
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            pruned += 1
+        self.last_result = (len(packed), pruned)
+        logger.info("Maintenance packed %d and pruned %d loose objects%s in %.3fs",
+                    len(packed), pruned,
+                    ' and consolidated {0} packs'.format(len(old_packs)) if consolidate else '',
+                    time.time() - start)
+        return self.last_result
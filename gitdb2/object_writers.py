@@ -0,0 +1,182 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import os
+import zlib
+import struct
+import hashlib
+import binascii
+import tempfile
+from collections import OrderedDict
+
+from pygit2 import Oid, GIT_OBJ_BLOB, GIT_OBJ_TREE, GIT_FILEMODE_TREE
+
+"""
+   Object writers create the blobs and trees of a commit.
+
+   `LooseObjectWriter` writes every object as loose object right away.
+   `PackObjectWriter` keeps the objects of a transaction in memory and writes
+   them as a single packfile with its index when the commit is applied, which
+   saves a file per object in large transactions.
+"""
+
+OBJECT_TYPE_NAMES = {
+    GIT_OBJ_BLOB: b'blob',
+    GIT_OBJ_TREE: b'tree',
+}
+
+
+def hash_object(object_type, data):
+    """Return the id of an object of object_type with content data"""
+    header = OBJECT_TYPE_NAMES[object_type] + b' ' + str(len(data)).encode('ascii') + b'\0'
+    return Oid(raw=hashlib.sha1(header + data).digest())
+
+
+def tree_sort_key(item):
+    # git sorts trees as if their names ended with a slash
+    name, (oid, filemode) = item
+    if filemode == GIT_FILEMODE_TREE:
+        return name.encode('utf-8') + b'/'
+    return name.encode('utf-8')
+
+
+def serialize_tree(entries):
+    """Return the content of a tree object with entries, a dictionary of
+       name -> (oid, filemode)"""
+    parts = []
+    for name, (oid, filemode) in sorted(entries.items(), key=tree_sort_key):
+        parts.append('{0:o} {1}'.format(filemode, name).encode('utf-8'))
+        parts.append(b'\0')
+        parts.append(oid.raw)
+    return b''.join(parts)
+
+
+def encode_pack_header(object_type, size):
+    """Return the variable length type and size header of a pack entry"""
+    byte = (object_type << 4) | (size & 0x0f)
+    size >>= 4
+    header = bytearray()
+    while size:
+        header.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    header.append(byte)
+    return bytes(header)
+
+
+def write_pack(pack_dir, objects):
+    """Write objects, a dictionary of oid -> (object_type, data), as packfile
+       with a version 2 index to pack_dir and return the pack name"""
+    fd, tmp_pack = tempfile.mkstemp(dir=pack_dir, suffix='.pack.tmp')
+    entries = []
+    pack_hash = hashlib.sha1()
+    try:
+        with os.fdopen(fd, 'wb') as pack_file:
+            def write(data):
+                pack_hash.update(data)
+                pack_file.write(data)
+            write(b'PACK' + struct.pack('>II', 2, len(objects)))
+            offset = 12
+            for oid, (object_type, data) in objects.items():
+                entry = encode_pack_header(object_type, len(data)) + zlib.compress(data)
+                entries.append((oid.raw, binascii.crc32(entry) & 0xffffffff, offset))
+                write(entry)
+                offset += len(entry)
+            pack_checksum = pack_hash.digest()
+            pack_file.write(pack_checksum)
+        name = 'pack-' + binascii.hexlify(pack_checksum).decode('ascii')
+        pack_filename = os.path.join(pack_dir, name + '.pack')
+        os.rename(tmp_pack, pack_filename)
+    except:
+        if os.path.exists(tmp_pack):
+            os.remove(tmp_pack)
+        raise
+
+    entries.sort()
+    fanout = [0] * 256
+    for raw, crc, offset in entries:
+        fanout[bytearray(raw[:1])[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    large_offsets = []
+    offsets = []
+    for raw, crc, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+    index = b''.join([
+        b'\xfftOc', struct.pack('>I', 2),
+        struct.pack('>256I', *fanout),
+        b''.join(raw for raw, crc, offset in entries),
+        b''.join(struct.pack('>I', crc) for raw, crc, offset in entries),
+        b''.join(struct.pack('>I', offset) for offset in offsets),
+        b''.join(struct.pack('>Q', offset) for offset in large_offsets),
+        pack_checksum,
+    ])
+    index += hashlib.sha1(index).digest()
+    fd, tmp_index = tempfile.mkstemp(dir=pack_dir, suffix='.idx.tmp')
+    with os.fdopen(fd, 'wb') as index_file:
+        index_file.write(index)
+    os.rename(tmp_index, os.path.join(pack_dir, name + '.idx'))
+    return name
+
+
+class LooseObjectWriter(object):
+    """Writes every object as loose object"""
+    def __init__(self, repo):
+        self.repo = repo
+
+    def write_blob(self, data):
+        return self.repo.create_blob(data)
+
+    def write_tree(self, entries):
+        """Write a tree with entries, a dictionary of
+           name -> (oid, filemode), and return its id"""
+        return self.repo.odb.write(GIT_OBJ_TREE, serialize_tree(entries))
+
+    def read(self, oid):
+        return self.repo[oid].data
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+class PackObjectWriter(object):
+    """Stages objects in memory and writes them as one packfile on `flush`"""
+    def __init__(self, repo):
+        self.repo = repo
+        self.pack_dir = os.path.join(repo.path, 'objects', 'pack')
+        self.objects = OrderedDict()
+
+    def write_object(self, object_type, data):
+        oid = hash_object(object_type, data)
+        if oid not in self.objects:
+            self.objects[oid] = (object_type, data)
+        return oid
+
+    def write_blob(self, data):
+        return self.write_object(GIT_OBJ_BLOB, data)
+
+    def write_tree(self, entries):
+        return self.write_object(GIT_OBJ_TREE, serialize_tree(entries))
+
+    def read(self, oid):
+        if oid in self.objects:
+            return self.objects[oid][1]
+        return self.repo[oid].data
+
+    def flush(self):
+        """Write the staged objects that are not yet in the repository"""
+        objects = OrderedDict((oid, value) for oid, value in self.objects.items()
+                              if not self.repo.odb.exists(oid))
+        self.objects = OrderedDict()
+        if objects:
+            write_pack(self.pack_dir, objects)
+
+    def clear(self):
+        self.objects = OrderedDict()
@@ -0,0 +1,144 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import os
+import errno
+import glob
+import shutil
+import hashlib
+import tempfile
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Version of the way rows are stored in the database. Cached databases
+# of other versions are never used.
+DATABASE_FORMAT_VERSION = 1
+
+# ioctl to clone the extents of a file on copy-on-write filesystems on Linux
+FICLONE = 0x40049409
+
+
+def schema_fingerprint(metadata):
+    """Return a hash of the sqlite schema of all tables in metadata"""
+    dialect = sqlite.dialect()
+    fingerprint = hashlib.sha1()
+    fingerprint.update('{0}\n'.format(DATABASE_FORMAT_VERSION).encode('utf-8'))
+    for table in metadata.sorted_tables:
+        ddl = str(sa.schema.CreateTable(table).compile(dialect=dialect))
+        fingerprint.update(ddl.encode('utf-8'))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            ddl = str(sa.schema.CreateIndex(index).compile(dialect=dialect))
+            fingerprint.update(ddl.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def copy_file(source, destination):
+    """Copy source to destination, as reflink if the filesystem supports it"""
+    if fcntl is not None:
+        with open(source, 'rb') as source_file:
+            with open(destination, 'wb') as destination_file:
+                try:
+                    fcntl.ioctl(destination_file.fileno(), FICLONE,
+                                source_file.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+    shutil.copyfile(source, destination)
+
+
+class SnapshotCache(object):
+    """Cache of database files shared by all repositories on a host.
+
+    Databases are keyed by the id of the root tree they have been built
+    from and the fingerprint of their schema, so any clone or worktree
+    can reuse a database that has been built for the same tree. The
+    least recently used databases are removed when the cache grows
+    beyond `max_size` bytes.
+    """
+    def __init__(self, path, max_size=2**30):
+        self.path = path
+        self.max_size = max_size
+
+    def get_filename(self, tree_id, fingerprint):
+        return os.path.join(self.path, '{0}-{1}.db'.format(tree_id, fingerprint))
+
+    def lookup(self, tree_id, fingerprint):
+        """Return the filename of the database of tree_id, or None if there
+        is no such database. The database is marked as recently used."""
+        filename = self.get_filename(tree_id, fingerprint)
+        try:
+            os.utime(filename, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return filename
+
+    def fetch(self, tree_id, fingerprint, destination):
+        """Copy the database of tree_id to destination.
+        Returns False if there is no such database."""
+        filename = self.lookup(tree_id, fingerprint)
+        if filename is None:
+            return False
+        try:
+            copy_file(filename, destination)
+        except (IOError, OSError) as e:
+            # evicted in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+            if os.path.exists(destination):
+                os.remove(destination)
+            return False
+        return True
+
+    def store(self, tree_id, fingerprint, source):
+        """Store a copy of the database file source as database of tree_id.
+        source may also be a function that writes the database to the
+        filename it is called with."""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            if callable(source):
+                os.remove(tmp_filename)
+                source(tmp_filename)
+            else:
+                copy_file(source, tmp_filename)
+            os.rename(tmp_filename, self.get_filename(tree_id, fingerprint))
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used databases until the cache is not larger
+        than max_size"""
+        entries = []
+        for filename in glob.glob(os.path.join(self.path, '*.db')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        size = sum(entry[1] for entry in entries)
+        for mtime, file_size, filename in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            size -= file_size
@@ -0,0 +1,154 @@
+from __future__ import print_function, division, absolute_import, \
+    unicode_literals
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boltons.fileutils import mkdir_p
+
+"""
+   Working copies mirror the committed files on disk.
+
+   `WorkingCopy` writes synchronously. `ThreadedWorkingCopy` hands the file
+   system operations to a pool of threads, so that flushing a session does
+   not wait for the disk. Operations on the same path are applied in order
+   and only the last pending operation of a path is executed. `flush` waits
+   until all operations have been applied.
+"""
+
+
+def remove_file_with_empty_parents(root, filename):
+    """Remove root/filename, also removing any empty parents
+       up to (but excluding) root"""
+    root = os.path.normpath(root)
+    full_filename = os.path.join(root, filename)
+    if os.path.isfile(full_filename):
+        os.remove(full_filename)
+    parent = os.path.normpath(os.path.dirname(full_filename))
+    while parent != root:
+        if os.path.isdir(parent):
+            if os.listdir(parent):
+                break
+            os.rmdir(parent)
+        parent = os.path.normpath(os.path.dirname(parent))
+
+
+class WorkingCopy(object):
+    """Applies changes to the working copy in `path` immediately"""
+    def __init__(self, path):
+        self.path = path
+        # creating files and removing empty directories must not interleave
+        # if several threads write
+        self.directory_lock = threading.Lock()
+
+    def write(self, filename, data):
+        real_filename = os.path.join(self.path, filename)
+        with self.directory_lock:
+            mkdir_p(os.path.dirname(real_filename))
+            outfile = open(real_filename, 'wb')
+        with outfile:
+            outfile.write(data)
+
+    def remove(self, filename):
+        with self.directory_lock:
+            remove_file_with_empty_parents(self.path, filename)
+
+    def move(self, old_filename, new_filename, read_data):
+        """Move old_filename to new_filename. read_data returns the content
+           of the file, for working copies that cannot rename."""
+        real_old_filename = os.path.join(self.path, old_filename)
+        real_new_filename = os.path.join(self.path, new_filename)
+        with self.directory_lock:
+            mkdir_p(os.path.dirname(real_new_filename))
+            os.rename(real_old_filename, real_new_filename)
+            remove_file_with_empty_parents(self.path, old_filename)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ThreadedWorkingCopy(object):
+    """Applies changes to the working copy in `path` in `workers` threads"""
+    def __init__(self, path, workers=4):
+        self.path = path
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # creating files and removing empty directories must not interleave
+        self.directory_lock = threading.Lock()
+        # filename -> last operation that has not been started yet
+        self.pending = {}
+        # filenames that are handled by a thread at the moment
+        self.running = set()
+        self.errors = []
+
+    def submit(self, filename, operation):
+        with self.lock:
+            self.pending[filename] = operation
+            if filename not in self.running:
+                self.running.add(filename)
+                self.executor.submit(self.process, filename)
+
+    def process(self, filename):
+        """Apply the pending operations of filename until there are none.
+           Operations submitted meanwhile are picked up by this loop, which
+           keeps the order of operations per path."""
+        while True:
+            with self.lock:
+                operation = self.pending.pop(filename, None)
+                if operation is None:
+                    self.running.discard(filename)
+                    if not self.running:
+                        self.idle.notify_all()
+                    return
+            try:
+                self.execute(filename, operation)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+    def execute(self, filename, operation):
+        if operation[0] == 'write':
+            data = operation[1]
+            real_filename = os.path.join(self.path, filename)
+            with self.directory_lock:
+                mkdir_p(os.path.dirname(real_filename))
+                outfile = open(real_filename, 'wb')
+            with outfile:
+                outfile.write(data)
+        elif operation[0] == 'remove':
+            with self.directory_lock:
+                remove_file_with_empty_parents(self.path, filename)
+        else:
+            raise ValueError(operation)
+
+    def write(self, filename, data):
+        self.submit(filename, ('write', data))
+
+    def remove(self, filename):
+        self.submit(filename, ('remove', ))
+
+    def move(self, old_filename, new_filename, read_data):
+        self.submit(new_filename, ('write', read_data()))
+        self.submit(old_filename, ('remove', ))
+
+    def flush(self):
+        """Wait until all submitted operations have been applied and raise
+           the first error that occured meanwhile"""
+        with self.lock:
+            while self.running:
+                self.idle.wait()
+            errors = self.errors
+            self.errors = []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
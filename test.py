@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
+import sys
 import unittest
 import errno
 import os
 import shutil
 import datetime
+import time
+import warnings
 import codecs
 import subprocess as sp
 
@@ -22,6 +25,8 @@ from sqlalchemy.ext.associationproxy import association_proxy
 
 from gitdb2 import *
 from gitdb2 import data_types
+from gitdb2.snapshot_cache import SnapshotCache, schema_fingerprint
+from gitdb2.maintenance import iter_loose_objects
 
 
 #@sa.event.listens_for(sa.engine.Engine, "connect")
@@ -91,6 +96,14 @@ def compare_tree(repo, tree, data):
             assert_equal(content, data[f])
 
 
+class NoSetupRepo(GitDBRepo):
+    """Fails if the database is rebuilt from git, by either path"""
+    def setup(self):
+        raise AssertionError('Database should not be rebuilt')
+    def bulkLoad(self):
+        raise AssertionError('Database should not be rebuilt')
+
+
 class BaseSessionTest(unittest.TestCase):
     test_dir = 'unittest_repo'
     def setUp(self):
@@ -212,10 +225,9 @@ class BaseSessionTest(unittest.TestCase):
         self.session.commit()
         self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe\n"}})
         self.newSession()
-        with self.assertRaises(NotImplementedError):
-            self.session.query(Test).delete()
-        #self.session.commit()
-        #self.check_repository({})
+        self.session.query(Test).delete()
+        self.session.commit()
+        self.check_repository({})
     def test_remove_objects_single(self):
         class Test(self.Base):
             __tablename__ = 'test'
@@ -512,6 +524,964 @@ class GitDBRepoTest(unittest.TestCase):
         test = self.session.query(Test).one()
         self.assertFalse(hasattr(test, '_foo'))
         self.assertEqual(test.foo, "blub")
+    def test_incremental_update(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        class Other(self.Base):
+            __tablename__ = 'other'
+            id = Column(Integer, primary_key = True)
+        self.initRepo()
+        self.session.add_all([Test(foo='probe'), Test(foo='gone'), Other()])
+        self.session.commit()
+        self.repo.close()
+        databasepath = os.path.join(self.test_dir, 'database.db')
+        shutil.copy(databasepath, databasepath + '.old')
+        with open(os.path.join(self.test_dir, 'dbcommit')) as f:
+            old_commit = f.read()
+        self.restartRepo()
+        self.session.query(Test).get(1).foo = 'changed'
+        self.session.delete(self.session.query(Test).get(2))
+        self.session.add(Test(foo='new'))
+        self.session.commit()
+        self.repo.close()
+        shutil.move(databasepath + '.old', databasepath)
+        with open(os.path.join(self.test_dir, 'dbcommit'), 'w') as f:
+            f.write(old_commit)
+
+        self.repo = NoSetupRepo(self.Base, self.test_dir)
+        self.session = self.repo.session
+        self.assertEqual(sorted((t.id, t.foo) for t in self.session.query(Test)),
+                         [(1, 'changed'), (3, 'new')])
+        self.assertEqual(self.session.query(Other).count(), 1)
+    def test_init_without_git_binary(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        def no_subprocess(*args, **kwargs):
+            raise AssertionError('git must not be called as subprocess')
+        popen = sp.Popen
+        sp.Popen = no_subprocess
+        try:
+            shutil.rmtree(self.test_dir)
+            self.repo = GitDBRepo.init(self.Base, self.test_dir)
+            self.session = self.repo.session
+            self.session.add(Test(foo='probe'))
+            self.session.commit()
+            self.restartRepo()
+            self.assertEqual(self.session.query(Test).one().foo, 'probe')
+            self.assertIn('open_repository', self.repo.timings)
+            self.assertIn('start_session', self.repo.timings)
+            self.assertNotIn('setup', self.repo.timings)
+        finally:
+            sp.Popen = popen
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe\n"}})
+    def test_lazy(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        class Other(self.Base):
+            __tablename__ = 'other'
+            id = Column(Integer, primary_key = True)
+        self.initRepo()
+        self.session.add_all([Test(foo='probe'), Other()])
+        self.session.commit()
+        self.repo.close()
+        os.remove(os.path.join(self.test_dir, 'database.db'))
+        self.repo = GitDBRepo(self.Base, self.test_dir, lazy=True)
+        self.session = self.repo.session
+        self.assertEqual(self.repo.hydrated, {})
+        self.assertEqual(self.session.query(Test).one().foo, 'probe')
+        self.assertEqual(list(self.repo.hydrated), ['test'])
+        self.session.add(Test(foo='new'))
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe\n",
+                                        '2.txt': "id: 2\nfoo: new\n"},
+                               'other': {'1.txt': "id: 1\n"}})
+        self.repo.close()
+        self.repo = GitDBRepo(self.Base, self.test_dir, lazy=True)
+        self.session = self.repo.session
+        self.assertEqual(list(self.repo.hydrated), ['test'])
+        self.assertEqual(self.session.query(Test).count(), 2)
+        self.session.add(Other())
+        self.session.flush()
+        self.assertEqual(sorted(self.repo.hydrated), ['other', 'test'])
+        self.session.rollback()
+        self.assertEqual(self.session.query(Other).count(), 1)
+        self.session.commit()
+        self.restartRepo()
+        self.assertIsNone(self.repo.hydrated)
+        self.assertEqual(self.session.query(Test).count(), 2)
+        self.assertEqual(self.session.query(Other).count(), 1)
+    def test_in_memory(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.repo = GitDBRepo(self.Base, self.test_dir, in_memory=True)
+        self.session = self.repo.session
+        self.session.add(Test(foo='probe'))
+        self.session.commit()
+        self.repo.close()
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'database.db')))
+        self.repo = NoSetupRepo(self.Base, self.test_dir, in_memory=True)
+        self.session = self.repo.session
+        self.assertEqual(self.session.query(Test).one().foo, 'probe')
+        self.repo.close()
+        # Change HEAD outside of the in-memory database
+        self.repo = GitDBRepo(self.Base, self.test_dir)
+        self.session = self.repo.session
+        self.session.add(Test(foo='new'))
+        self.session.commit()
+        self.repo.close()
+        self.repo = NoSetupRepo(self.Base, self.test_dir, in_memory=True)
+        self.session = self.repo.session
+        self.assertEqual(self.session.query(Test).count(), 2)
+        self.repo.close()
+        snapshots = os.listdir(os.path.join(self.test_dir, '.git', 'gitdb2'))
+        self.assertEqual(snapshots, ['database.db.' + self.repo.getCurrentCommit()])
+    def test_bulk_load(self):
+        class Parent(self.Base):
+            __tablename__ = 'parents'
+            id = Column(Integer, primary_key = True)
+            name = Column(String, index=True)
+        class Child(self.Base):
+            __tablename__ = 'children'
+            id = Column(Integer, primary_key = True)
+            parent_id = Column(Integer, ForeignKey(Parent.id))
+            parent = relationship(Parent, backref='children')
+        self.repo = GitDBRepo(self.Base, self.test_dir, in_memory=True)
+        self.session = self.repo.session
+        self.session.add(Parent(name='probe', children=[Child(), Child()]))
+        self.session.commit()
+        synchronous = self.session.execute('PRAGMA synchronous').scalar()
+        self.repo.close()
+        shutil.rmtree(os.path.join(self.test_dir, '.git', 'gitdb2'))
+        self.repo = GitDBRepo(self.Base, self.test_dir, in_memory=True)
+        self.session = self.repo.session
+        for phase in ['create_tables', 'load', 'create_indexes']:
+            self.assertIn('bulk_load.' + phase, self.repo.timings)
+        self.assertEqual(self.session.execute('PRAGMA synchronous').scalar(), synchronous)
+        indexes = sa.inspect(self.repo.engine).get_indexes('parents')
+        self.assertEqual([index['column_names'] for index in indexes], [['name']])
+        parent = self.session.query(Parent).one()
+        self.assertEqual(parent.name, 'probe')
+        self.assertEqual(len(parent.children), 2)
+    def test_snapshot_cache(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        cache_dir = 'unittest_cache'
+        clone_dir = 'unittest_clone'
+        for directory in [cache_dir, clone_dir]:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+        self.initRepo()
+        self.session.add(Test(foo='probe'))
+        self.session.commit()
+        self.restartRepo(reloadDatabase=True)
+        self.repo.close()
+        self.repo = GitDBRepo(self.Base, self.test_dir, snapshot_cache=cache_dir)
+        self.assertFalse(os.path.exists(cache_dir))
+        self.repo.close()
+        os.remove(os.path.join(self.test_dir, 'database.db'))
+        self.repo = GitDBRepo(self.Base, self.test_dir, snapshot_cache=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.repo.close()
+
+        pygit2.clone_repository(self.test_dir, clone_dir)
+        for in_memory in [False, True]:
+            clone = NoSetupRepo(self.Base, clone_dir, snapshot_cache=cache_dir,
+                                in_memory=in_memory)
+            self.assertEqual(clone.session.query(Test).one().foo, 'probe')
+            clone.close()
+
+        # A different schema does not use the cached database
+        Test.__table__.append_column(Column('bar', String))
+        self.assertNotEqual(schema_fingerprint(self.Base.metadata), self.repo.schema_fingerprint)
+
+        cache = SnapshotCache(cache_dir, max_size=0)
+        cache.evict()
+        self.assertEqual(os.listdir(cache_dir), [])
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(clone_dir)
+    def test_parallel_setup(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(id=i, foo='probe\n{0}'.format(i)) for i in range(0, 2000, 7)])
+        self.session.commit()
+        self.restartRepo(reloadDatabase=True)
+        serial_rows = [(t.id, t.foo) for t in self.session.query(Test)]
+        self.repo.close()
+        os.remove(os.path.join(self.test_dir, 'database.db'))
+        self.repo = GitDBRepo(self.Base, self.test_dir, setup_workers=3, setup_chunk_size=10)
+        self.session = self.repo.session
+        self.assertEqual([(t.id, t.foo) for t in self.session.query(Test)], serial_rows)
+    def test_parallel_setup_packed(self):
+        from gitdb2.layouts import PackedLayout
+        class Test(self.Base):
+            __tablename__ = 'test'
+            __layout__ = PackedLayout(buckets=8)
+            id = Column(String, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(id='k{0:03}'.format(i), foo='probe') for i in range(60)])
+        self.session.commit()
+        def read_rowid_order(**kwargs):
+            self.repo.close()
+            os.remove(os.path.join(self.test_dir, 'database.db'))
+            self.repo = GitDBRepo(self.Base, self.test_dir, setup_chunk_size=10, **kwargs)
+            self.session = self.repo.session
+            return [row[0] for row in self.session.execute('SELECT id FROM test ORDER BY rowid')]
+        self.assertEqual(read_rowid_order(setup_workers=3), read_rowid_order())
+    def test_chunked_setup(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(id=i, foo='probe') for i in range(1, 150)])
+        self.session.commit()
+        self.repo.close()
+        os.remove(os.path.join(self.test_dir, 'database.db'))
+        self.repo = GitDBRepo(self.Base, self.test_dir, setup_chunk_size=7)
+        self.session = self.repo.session
+        self.assertEqual([t.id for t in self.session.query(Test)], list(range(1, 150)))
+        chunks = list(self.repo.readTable(Test, self.repo.repo.head.peel().tree['test']))
+        self.assertEqual([len(chunk) for chunk in chunks], [7] * 21 + [2])
+        for chunk in chunks:
+            self.assertEqual(chunk, sorted(chunk, key=lambda values: values['id']))
+
+    def test_large_binary(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+            data = Column(sa.LargeBinary)
+            text = Column(sa.Text, info={'gitdb_blob': True})
+        self.initRepo()
+        payload = b'\x00\x01binary\npayload'
+        self.session.add_all([Test(foo='probe', data=payload, text='line\nline'),
+                              Test(foo='copy', data=payload)])
+        self.session.commit()
+        blob_id = pygit2.hash(payload).hex
+        text_id = pygit2.hash(b'line\nline').hex
+        self.check_repository({'test': {
+            '1.txt': "id: 1\nfoo: probe\ndata: {0}\ntext: {1}\n".format(blob_id, text_id),
+            '1.data.blob': None,
+            '1.text.blob': "line\nline",
+            '2.txt': "id: 2\nfoo: copy\ndata: {0}\n".format(blob_id),
+            '2.data.blob': None}})
+
+        written = []
+        write_bytes = self.repo.gitDBSession.git_handler.write_bytes
+        def recording_write_bytes(filename, data):
+            written.append(filename)
+            return write_bytes(filename, data)
+        self.repo.gitDBSession.git_handler.write_bytes = recording_write_bytes
+        test = self.session.query(Test).get(1)
+        test.foo = 'changed'
+        test.id = 3
+        self.session.commit()
+        self.assertEqual(written, ['test/3.txt'])
+        self.check_repository({'test': {
+            '3.txt': "id: 3\nfoo: changed\ndata: {0}\ntext: {1}\n".format(blob_id, text_id),
+            '3.data.blob': None,
+            '3.text.blob': "line\nline",
+            '2.txt': "id: 2\nfoo: copy\ndata: {0}\n".format(blob_id),
+            '2.data.blob': None}})
+
+        self.session.query(Test).get(3).text = None
+        self.session.delete(self.session.query(Test).get(2))
+        self.session.commit()
+        self.check_repository({'test': {
+            '3.txt': "id: 3\nfoo: changed\ndata: {0}\n".format(blob_id),
+            '3.data.blob': None}})
+
+        self.restartRepo(reloadDatabase=True)
+        test = self.session.query(Test).one()
+        self.assertEqual(test.data, payload)
+        self.assertIsNone(test.text)
+
+        # unchanged blob columns are not loaded to write the row
+        self.session.expunge_all()
+        test = self.session.query(Test).options(sa.orm.defer('data')).one()
+        test.foo = 'deferred'
+        self.session.flush()
+        self.assertNotIn('data', sa.inspect(test).dict)
+        self.session.commit()
+        self.check_repository({'test': {
+            '3.txt': "id: 3\nfoo: deferred\ndata: {0}\n".format(blob_id),
+            '3.data.blob': None}})
+
+    def test_packed_layout(self):
+        from gitdb2.layouts import PackedLayout, parse_bucket
+        class Test(self.Base):
+            __tablename__ = 'test'
+            __layout__ = PackedLayout(buckets=4)
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(foo='probe {0}'.format(i)) for i in range(20)])
+        self.session.commit()
+        def read_buckets():
+            repo = pygit2.Repository(self.test_dir)
+            tree = repo[repo.head.target].tree
+            return {entry.name: entry.id for entry in repo[tree['test'].id]}
+        buckets = read_buckets()
+        self.assertEqual(len(buckets), 4)
+        self.assertTrue(all(name.endswith('.rows') for name in buckets))
+        rows = {}
+        for name in buckets:
+            with codecs.open(os.path.join(self.test_dir, 'test', name), encoding='utf-8') as f:
+                rows.update(parse_bucket(f.read()))
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(rows['3'], 'id: 3\nfoo: probe 2\n')
+
+        self.session.query(Test).get(3).foo = 'changed'
+        self.session.commit()
+        changed = read_buckets()
+        self.assertEqual(len([name for name in buckets if buckets[name] != changed[name]]), 1)
+
+        self.session.delete(self.session.query(Test).get(4))
+        self.session.query(Test).get(5).id = 25
+        self.session.commit()
+        expected = [(i + 1, 'probe {0}'.format(i)) for i in range(20) if i + 1 not in (3, 4, 5)]
+        expected = sorted(expected + [(3, 'changed'), (25, 'probe 4')])
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(sorted((t.id, t.foo) for t in self.session.query(Test)), expected)
+
+    def test_relayout(self):
+        from gitdb2.layouts import HashSharding
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+            data = Column(sa.LargeBinary)
+        self.initRepo()
+        self.session.add_all([Test(foo='probe'), Test(id=1234, foo='long', data=b'payload')])
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': None, '12': {'1234.txt': None, '1234.data.blob': None}}})
+
+        layout = RowPerFileLayout(HashSharding(depth=2, width=1))
+        self.assertEqual(layout.get_filename('test', 1), 'test/3/5/1.txt')
+        self.assertEqual(layout.get_filename('test', 1234), 'test/7/1/1234.txt')
+        Test.__layout__ = layout
+        self.restartRepo()
+        self.repo.relayout()
+        self.check_repository({'test': {
+            '3': {'5': {'1.txt': "id: 1\nfoo: probe\n"}},
+            '7': {'1': {'1234.txt': None, '1234.data.blob': 'payload'}}}})
+
+        self.session.delete(self.session.query(Test).get(1234))
+        self.session.commit()
+        test = self.session.query(Test).get(1)
+        test.id = 1234
+        test.data = b'new'
+        self.session.commit()
+        self.check_repository({'test': {
+            '7': {'1': {'1234.txt': None, '1234.data.blob': 'new'}}}})
+        self.restartRepo(reloadDatabase=True)
+        test = self.session.query(Test).one()
+        self.assertEqual((test.id, test.foo, test.data), (1234, 'probe', b'new'))
+
+    def test_tree_index(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        git_handler = self.repo.gitDBSession.git_handler
+        self.session.add_all([Test(id=1, foo='probe'), Test(id=1234, foo='long'), Test(id=1299)])
+        self.session.commit()
+        def check_index():
+            tree = self.repo.getCurrentTree()
+            for filename, blob_id in iter_blobs(self.repo.repo, tree):
+                self.assertEqual(git_handler.tree_index.get(filename), (blob_id, pygit2.GIT_FILEMODE_BLOB))
+            for directory, entries in git_handler.tree_index.directories.items():
+                sub_tree = tree
+                for name in directory.split('/') if directory else []:
+                    sub_tree = self.repo.repo[sub_tree[name].id] if sub_tree is not None and name in sub_tree else None
+                expected = {} if sub_tree is None else {e.name: (e.id, e.filemode) for e in sub_tree}
+                self.assertEqual(entries, expected)
+        self.assertEqual(git_handler.tree_index.get_id('test/12/1234.txt'),
+                         pygit2.hash(b'id: 1234\nfoo: long\n'))
+        check_index()
+        # directories in the mirror are not read from the repository again
+        tree_index_repo = git_handler.tree_index.repo
+        git_handler.tree_index.repo = None
+        self.session.query(Test).get(1).foo = 'mirrored'
+        self.session.query(Test).get(1234).foo = 'mirrored'
+        self.session.commit()
+        git_handler.tree_index.repo = tree_index_repo
+        check_index()
+        self.session.query(Test).get(1).foo = 'changed'
+        self.session.delete(self.session.query(Test).get(1234))
+        self.session.delete(self.session.query(Test).get(1299))
+        self.session.commit()
+        check_index()
+        self.assertNotIn('12', self.repo.repo[self.repo.getCurrentTree()['test'].id])
+        self.assertIsNone(git_handler.tree_index.get('test/12'))
+
+    def test_pack_objects(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+            data = Column(sa.LargeBinary)
+        self.repo = GitDBRepo(self.Base, self.test_dir, pack_objects=True)
+        self.session = self.repo.session
+        objects_dir = os.path.join(self.test_dir, '.git', 'objects')
+        def loose_objects():
+            return [name for directory in os.listdir(objects_dir) if len(directory) == 2
+                    for name in os.listdir(os.path.join(objects_dir, directory))]
+        before = len(loose_objects())
+        self.session.add_all([Test(id=i, foo='probe {0}'.format(i), data=b'\x00' * i)
+                              for i in range(1, 1200)])
+        self.session.commit()
+        # only the commit object is written as loose object
+        self.assertEqual(len(loose_objects()), before + 1)
+        self.assertEqual(len([name for name in os.listdir(os.path.join(objects_dir, 'pack'))
+                              if name.endswith('.idx')]), 1)
+        self.session.query(Test).get(1000).foo = 'changed'
+        self.session.delete(self.session.query(Test).get(3))
+        self.session.commit()
+        self.assertEqual(len(loose_objects()), before + 2)
+        self.assertEqual(sp.check_output(['git', 'fsck', '--strict', '--no-dangling'], cwd=self.test_dir,
+                                         stderr=sp.STDOUT).strip(), b'')
+        self.assertEqual(sp.check_output(['git', 'show', 'HEAD:test/10/1000.txt'], cwd=self.test_dir),
+                         b'id: 1000\nfoo: changed\ndata: ' + pygit2.hash(b'\x00' * 1000).hex.encode('ascii') + b'\n')
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(self.session.query(Test).count(), 1198)
+        self.assertEqual(self.session.query(Test).get(1000).foo, 'changed')
+        self.assertEqual(self.session.query(Test).get(5).data, b'\x00' * 5)
+
+    def test_maintenance(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        maintenance = RepositoryMaintenance(self.test_dir, loose_threshold=0, prune_grace=3600)
+        self.repo = GitDBRepo(self.Base, self.test_dir, maintenance=maintenance)
+        self.session = self.repo.session
+        objects_dir = os.path.join(self.test_dir, '.git', 'objects')
+        def loose_objects():
+            return set(oid for oid, filename in iter_loose_objects(objects_dir))
+        # an orphaned blob of a rolled back transaction
+        orphan = pygit2.Repository(self.test_dir).create_blob(b'orphan')
+        orphan_filename = os.path.join(objects_dir, orphan.hex[:2], orphan.hex[2:])
+        os.utime(orphan_filename, (0, 0))
+        recent_orphan = pygit2.Repository(self.test_dir).create_blob(b'recent orphan')
+        maintenance.estimate_loose_objects = lambda: 1
+        self.session.add_all([Test(foo='probe {0}'.format(i)) for i in range(50)])
+        self.session.commit()
+        maintenance.join()
+        packed, pruned = maintenance.last_result
+        self.assertGreater(packed, 50)
+        self.assertEqual(pruned, 1)
+        self.assertFalse(os.path.exists(orphan_filename))
+        self.assertEqual(loose_objects() - set([empty_tree_id]), set([recent_orphan]))
+        self.assertEqual(sp.check_output(['git', 'fsck', '--strict', '--no-dangling'], cwd=self.test_dir,
+                                         stderr=sp.STDOUT).strip(), b'')
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(self.session.query(Test).count(), 50)
+
+    def test_maintenance_packs(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        maintenance = RepositoryMaintenance(self.test_dir, pack_threshold=4, prune_grace=0,
+                                            background=False)
+        self.repo = GitDBRepo(self.Base, self.test_dir, pack_objects=True,
+                              maintenance=maintenance)
+        self.session = self.repo.session
+        pack_dir = os.path.join(self.test_dir, '.git', 'objects', 'pack')
+        def packs():
+            return [name for name in os.listdir(pack_dir) if name.endswith('.idx')]
+        for i in range(4):
+            self.session.add(Test(foo='probe {0}'.format(i)))
+            self.session.commit()
+        self.assertEqual(len(packs()), 4)
+        self.session.add(Test(foo='probe 4'))
+        self.session.commit()
+        self.assertEqual(len(packs()), 1)
+        self.assertEqual(sp.check_output(['git', 'fsck', '--strict', '--no-dangling'], cwd=self.test_dir,
+                                         stderr=sp.STDOUT).strip(), b'')
+        self.session.add(Test(foo='probe 5'))
+        self.session.commit()
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(self.session.query(Test).count(), 6)
+
+    def test_incremental_index(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        git_handler = self.repo.gitDBSession.git_handler
+        def git_status():
+            return sp.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                   cwd=self.test_dir)
+        self.session.add_all([Test(foo='probe'), Test(id=1234, foo='long')])
+        self.session.commit()
+        self.assertEqual(git_status(), b'')
+        self.session.query(Test).get(1).foo = 'changed'
+        self.session.delete(self.session.query(Test).get(1234))
+        self.session.add(Test(id=5678, foo='new'))
+        self.session.commit()
+        self.assertEqual(git_status(), b'')
+        self.assertEqual(git_handler.index_tree_id, self.repo.getCurrentTree().id)
+
+        # move HEAD outside of this process without touching the working copy
+        repo = pygit2.Repository(self.test_dir)
+        head = repo[repo.head.target]
+        tree_builder = repo.TreeBuilder(repo[head.tree['test'].id])
+        tree_builder.insert('1.txt', repo.create_blob(b'id: 1\nfoo: external\n'), pygit2.GIT_FILEMODE_BLOB)
+        tree_builder.insert('2.txt', repo.create_blob(b'id: 2\nfoo: added\n'), pygit2.GIT_FILEMODE_BLOB)
+        root_builder = repo.TreeBuilder(head.tree)
+        root_builder.insert('test', tree_builder.write(), pygit2.GIT_FILEMODE_TREE)
+        signature = pygit2.Signature('external', 'external@example.com')
+        repo.create_commit('refs/heads/master', signature, signature, 'external',
+                           root_builder.write(), [head.id])
+        self.session.rollback()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: external\n",
+                                        '2.txt': "id: 2\nfoo: added\n",
+                                        '56': {'5678.txt': "id: 5678\nfoo: new\n"}}})
+        self.assertEqual(git_status(), b'')
+
+    def test_threaded_working_copy(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.repo = GitDBRepo(self.Base, self.test_dir, working_copy_workers=4)
+        self.session = self.repo.session
+        self.session.add_all([Test(id=i, foo='probe') for i in range(1, 101)])
+        self.session.commit()
+        self.assertEqual(len(os.listdir(os.path.join(self.test_dir, 'test'))), 100)
+        test = self.session.query(Test).get(1)
+        test.id = 1234
+        self.session.flush()
+        test.foo = 'changed'
+        self.session.commit()
+        for i in range(2, 101):
+            self.session.delete(self.session.query(Test).get(i))
+        self.session.commit()
+        self.check_repository({'test': {'12': {'1234.txt': "id: 1234\nfoo: changed\n"}}})
+
+        from gitdb2.working_copy import ThreadedWorkingCopy
+        working_copy = ThreadedWorkingCopy(self.test_dir, workers=2)
+        for i in range(20):
+            working_copy.write('other/a.txt', str(i).encode('ascii'))
+            working_copy.write('other/b/c.txt', b'c')
+            working_copy.remove('other/b/c.txt')
+        working_copy.flush()
+        with open(os.path.join(self.test_dir, 'other', 'a.txt')) as f:
+            self.assertEqual(f.read(), '19')
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'other', 'b')))
+        working_copy.write('other/a.txt/d.txt', b'')
+        self.assertRaises(OSError, working_copy.flush)
+        working_copy.close()
+        shutil.rmtree(os.path.join(self.test_dir, 'other'))
+
+    def test_group_commit(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        policy = GroupCommitPolicy(max_delay=None, max_operations=5)
+        self.repo = GitDBRepo(self.Base, self.test_dir, group_commit=policy)
+        self.session = self.repo.session
+        git_repo = pygit2.Repository(self.test_dir)
+        dbcommit = os.path.join(self.test_dir, 'dbcommit')
+        for i in range(1, 4):
+            self.session.add(Test(id=i, foo='probe'))
+            self.session.commit()
+        self.assertTrue(git_repo.head_is_unborn)
+        self.assertFalse(os.path.exists(dbcommit))
+        self.session.add(Test(id=4, foo='rolled back'))
+        self.session.flush()
+        self.session.rollback()
+        test = self.session.query(Test).get(1)
+        test.foo = 'changed'
+        self.session.commit()
+        self.repo.flush()
+        self.assertTrue(os.path.exists(dbcommit))
+        commit = git_repo[git_repo.head.target]
+        self.assertEqual(commit.parents, [])
+        self.assertEqual(commit.message.split('\n'), [
+            'Group commit of 4 transactions', '',
+            '    A  test/1.txt', '    A  test/2.txt', '    A  test/3.txt'])
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: changed\n",
+                                        '2.txt': "id: 2\nfoo: probe\n",
+                                        '3.txt': "id: 3\nfoo: probe\n"}})
+
+        # reverting a change of a waiting transaction
+        test.foo = 'reverted'
+        self.session.commit()
+        test.foo = 'changed'
+        self.session.commit()
+        self.repo.flush()
+        self.assertEqual(git_repo.head.target, commit.id)
+
+        self.session.add_all([Test(id=i, foo='probe') for i in range(10, 15)])
+        self.session.commit()
+        self.assertEqual(len(git_repo[git_repo.head.target].tree['test']), 8)
+
+        policy.max_delay = 0.05
+        head = git_repo.head.target
+        self.session.add(Test(id=20, foo='probe'))
+        self.session.commit()
+        for i in range(100):
+            if git_repo.head.target != head:
+                break
+            time.sleep(0.01)
+        self.assertEqual(git_repo[git_repo.head.target].message, '    A  test/20.txt')
+
+        self.session.add(Test(id=21, foo='probe'))
+        policy.max_delay = None
+        self.session.commit()
+        self.restartRepo()
+        self.assertEqual(self.session.query(Test).get(21).foo, 'probe')
+        self.assertEqual(git_repo[git_repo.head.target].message, '    A  test/21.txt')
+
+    def test_group_commit_pack_objects(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.repo = GitDBRepo(self.Base, self.test_dir, pack_objects=True,
+                              group_commit=GroupCommitPolicy(max_delay=None))
+        self.session = self.repo.session
+        self.session.add(Test(id=1, foo='probe'))
+        self.session.commit()
+        self.session.add(Test(id=2, foo='rolled back'))
+        self.session.flush()
+        self.session.rollback()
+        self.repo.flush()
+        git_repo = pygit2.Repository(self.test_dir)
+        tree = git_repo[git_repo.head.target].tree
+        self.assertEqual(git_repo[tree['test/1.txt'].id].data, b'id: 1\nfoo: probe\n')
+        sp.check_output(['git', 'fsck', '--strict'], cwd=self.test_dir)
+
+    def test_group_commit_timer(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.repo = GitDBRepo(self.Base, self.test_dir, lazy=True, in_memory=True,
+                              group_commit=GroupCommitPolicy(max_delay=0.2))
+        self.session = self.repo.session
+        git_repo = pygit2.Repository(self.test_dir)
+        self.session.add(Test(id=1, foo='probe'))
+        self.session.commit()
+        self.session.add(Test(id=2, foo='rolled back'))
+        self.session.flush()
+        for i in range(100):
+            if not git_repo.head_is_unborn:
+                break
+            time.sleep(0.01)
+        self.assertFalse(git_repo.head_is_unborn)
+        # the commit of the timer must not commit the open transaction
+        self.session.rollback()
+        self.assertEqual([t.id for t in self.session.query(Test)], [1])
+        self.restartRepo()
+        self.assertEqual([t.id for t in self.session.query(Test)], [1])
+
+    def test_concurrent_writers(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        class Packed(self.Base):
+            __tablename__ = 'packed'
+            __layout__ = PackedLayout(buckets=1)
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(id=1, foo='probe'), Packed(id=1, foo='probe'),
+                              Packed(id=2, foo='probe')])
+        self.session.commit()
+        other = GitDBRepo(self.Base, self.test_dir, in_memory=True, update_working_copy=False)
+        try:
+            self.session.add(Test(id=2, foo='first'))
+            self.session.query(Packed).get(1).foo = 'first'
+            self.session.commit()
+            other.session.add(Test(id=3, foo='second'))
+            other.session.query(Packed).get(2).foo = 'second'
+            other.session.commit()
+            self.assertEqual(sorted((t.id, t.foo) for t in other.session.query(Test)),
+                             [(1, 'probe'), (2, 'first'), (3, 'second')])
+            self.assertEqual(sorted((t.id, t.foo) for t in other.session.query(Packed)),
+                             [(1, 'first'), (2, 'second')])
+
+            self.session.rollback()
+            self.assertEqual(self.session.query(Test).get(3).foo, 'second')
+            self.assertEqual(self.session.query(Packed).get(2).foo, 'second')
+            self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe\n",
+                                            '2.txt': "id: 2\nfoo: first\n",
+                                            '3.txt': "id: 3\nfoo: second\n"},
+                                   'packed': {'0000.rows': None}})
+
+            self.session.query(Test).get(1).foo = 'first'
+            self.session.commit()
+            other.session.query(Test).get(1).foo = 'second'
+            other.session.query(Test).get(2).foo = 'second'
+            with self.assertRaises(ConflictError) as context:
+                other.session.commit()
+            self.assertEqual(context.exception.conflicts, ['test/1.txt'])
+            self.assertEqual(other.session.query(Test).get(1).foo, 'first')
+            self.assertEqual(other.session.query(Test).get(2).foo, 'first')
+
+            self.session.query(Packed).get(1).foo = 'third'
+            self.session.commit()
+            other.refresh()
+            self.assertEqual(other.session.query(Packed).get(1).foo, 'third')
+        finally:
+            other.close()
+        self.restartRepo()
+        self.assertEqual(self.session.query(Test).get(3).foo, 'second')
+
+    def test_branches(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        git_repo = pygit2.Repository(self.test_dir)
+        self.session.add(Test(id=1, foo='master'))
+        self.session.commit()
+        master = git_repo.references['refs/heads/master'].target
+
+        self.repo.switchBranch('feature')
+        self.assertEqual(git_repo.head.name, 'refs/heads/feature')
+        self.session.add(Test(id=2, foo='feature'))
+        self.session.query(Test).get(1).foo = 'changed'
+        self.session.commit()
+        self.assertEqual(git_repo.references['refs/heads/master'].target, master)
+        feature = git_repo.references['refs/heads/feature'].target
+        self.assertEqual(git_repo[feature].parents[0].id, master)
+
+        self.repo.switchBranch('master')
+        self.assertEqual([(t.id, t.foo) for t in self.session.query(Test)], [(1, 'master')])
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: master\n"}})
+        self.session.add(Test(id=3, foo='master'))
+        self.session.commit()
+
+        self.repo.switchBranch('feature')
+        self.assertEqual(sorted((t.id, t.foo) for t in self.session.query(Test)),
+                         [(1, 'changed'), (2, 'feature')])
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: changed\n",
+                                        '2.txt': "id: 2\nfoo: feature\n"}})
+        snapshots = sorted(os.listdir(os.path.join(self.test_dir, '.git', 'gitdb2')))
+        self.assertEqual(snapshots, sorted(['database.db.' + feature.hex,
+                                            'database.db.' + git_repo.references['refs/heads/master'].target.hex]))
+        self.repo.close()
+
+        self.repo = NoSetupRepo(self.Base, self.test_dir, in_memory=True, branch='master',
+                                update_working_copy=False)
+        self.session = self.repo.session
+        self.assertEqual(sorted(t.id for t in self.session.query(Test)), [1, 3])
+
+    def test_threadsafe(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        class Packed(self.Base):
+            __tablename__ = 'packed'
+            __layout__ = PackedLayout(buckets=1)
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        import threading
+        self.repo = GitDBRepo(self.Base, self.test_dir, threadsafe=True)
+        self.session = self.repo.session
+        errors = []
+        def work(thread):
+            try:
+                for i in range(10):
+                    row_id = thread * 100 + i
+                    self.session.add_all([Test(id=row_id, foo='thread {0}'.format(thread)),
+                                          Packed(id=row_id, foo='probe')])
+                    self.session.commit()
+                    if i == 5:
+                        self.session.add(Test(id=row_id + 50, foo='rolled back'))
+                        self.session.flush()
+                        self.session.rollback()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.session.remove()
+        threads = [threading.Thread(target=work, args=(thread, )) for thread in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        ids = sorted(thread * 100 + i for thread in range(1, 5) for i in range(10))
+        tree = self.repo.getCurrentTree()
+        self.assertEqual(sorted(int(name[:-4]) for name, blob_id in
+                                iter_blobs(self.repo.repo, self.repo.repo[tree['test'].id])),
+                         ids)
+        self.assertEqual(len(self.repo.repo[tree['packed'].id]), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'test', '155.txt')))
+        self.assertEqual(sp.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         cwd=self.test_dir), b'')
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(sorted(t.id for t in self.session.query(Test)), ids)
+        self.assertEqual(sorted(t.id for t in self.session.query(Packed)), ids)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio API needs Python 3.5')
+    def test_async(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        import asyncio
+        import threading
+        from gitdb2.aio import AsyncGitDBRepo
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        repo = AsyncGitDBRepo(self.Base, self.test_dir)
+        try:
+            loop.run_until_complete(repo.__aenter__())
+            self.assertNotEqual(loop.run_until_complete(repo.call(threading.current_thread)),
+                                threading.current_thread())
+            loop.run_until_complete(asyncio.gather(*[
+                repo.run(lambda session, i=i: session.add(Test(id=i, foo='probe'))) for i in range(1, 6)]))
+            loop.run_until_complete(repo.commit())
+            self.assertEqual(loop.run_until_complete(repo.run(lambda session: session.query(Test).count())), 5)
+            loop.run_until_complete(repo.run(lambda session: session.add(Test(id=1))))
+            with self.assertRaises(sa.exc.IntegrityError):
+                loop.run_until_complete(repo.commit())
+            loop.run_until_complete(repo.rollback())
+            loop.run_until_complete(repo.__aexit__(None, None, None))
+            self.assertIsNone(repo.repo)
+        finally:
+            loop.run_until_complete(repo.close())
+            loop.close()
+            asyncio.set_event_loop(None)
+        self.initRepo()
+        self.assertEqual(self.session.query(Test).count(), 5)
+        self.check_repository({'test': dict(('{0}.txt'.format(i), "id: {0}\nfoo: probe\n".format(i))
+                                            for i in range(1, 6))})
+    def test_bulk_statements(self):
+        from gitdb2.layouts import PackedLayout
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        class Packed(self.Base):
+            __tablename__ = 'packed'
+            __layout__ = PackedLayout(buckets=2)
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+        self.initRepo()
+        self.session.add_all([Test(foo='probe {0}'.format(i)) for i in range(1, 5)])
+        self.session.add_all([Packed(foo='probe {0}'.format(i)) for i in range(1, 5)])
+        self.session.commit()
+
+        self.session.query(Test).filter(Test.id > 2).delete(synchronize_session=False)
+        self.session.query(Test).filter(Test.id == 1).update({'foo': 'changed'})
+        self.session.query(Packed).filter(Packed.id <= 2).delete(synchronize_session=False)
+        self.session.query(Packed).update({Packed.foo: Packed.foo + '!'},
+                                          synchronize_session=False)
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: changed\n",
+                                        '2.txt': "id: 2\nfoo: probe 2\n"},
+                               'packed': None})
+        self.assertEqual(len(pygit2.Repository(self.test_dir).head.peel().parents), 1)
+
+        # changed primary keys move the files
+        self.session.query(Test).update({Test.id: Test.id + 10}, synchronize_session=False)
+        self.session.commit()
+        self.check_repository({'test': {'11.txt': "id: 11\nfoo: changed\n",
+                                        '12.txt': "id: 12\nfoo: probe 2\n"},
+                               'packed': None})
+
+        # a rolled back bulk statement leaves no changes
+        self.session.query(Test).delete(synchronize_session=False)
+        self.session.rollback()
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(sorted((t.id, t.foo) for t in self.session.query(Test)),
+                         [(11, 'changed'), (12, 'probe 2')])
+        self.assertEqual(sorted((t.id, t.foo) for t in self.session.query(Packed)),
+                         [(3, 'probe 3!'), (4, 'probe 4!')])
+    def test_core_inserts(self):
+        class Test(self.Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            foo = Column(String)
+            bar = Column(String, server_default='default')
+        self.initRepo()
+        table = Test.__table__
+        self.session.execute(table.insert(), [{'id': 1, 'foo': 'probe 1', 'bar': 'x'},
+                                              {'id': 2, 'foo': 'probe 2', 'bar': 'y'}])
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe 1\nbar: x\n",
+                                        '2.txt': "id: 2\nfoo: probe 2\nbar: y\n"}})
+
+        # rows without primary keys and server defaults are read back
+        self.session.execute(table.insert(), [{'foo': 'probe 3'}, {'foo': 'probe 4'}])
+        self.session.bulk_insert_mappings(Test, [{'id': 10, 'foo': 'probe 10', 'bar': 'z'}])
+        self.session.add(Test(foo='probe 11', bar='orm'))
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: probe 1\nbar: x\n",
+                                        '2.txt': "id: 2\nfoo: probe 2\nbar: y\n",
+                                        '3.txt': "id: 3\nfoo: probe 3\nbar: default\n",
+                                        '4.txt': "id: 4\nfoo: probe 4\nbar: default\n",
+                                        '10.txt': "id: 10\nfoo: probe 10\nbar: z\n",
+                                        '11.txt': "id: 11\nfoo: probe 11\nbar: orm\n"}})
+
+        # updates and deletes by primary key are read back by key
+        self.session.bulk_update_mappings(Test, [{'id': 1, 'foo': 'changed 1'},
+                                                 {'id': 2, 'foo': 'changed 2'}])
+        test = self.session.query(Test).get(3)
+        self.session.expunge(test)
+        test.foo = 'changed 3'
+        self.session.bulk_save_objects([test])
+        self.session.execute(table.delete().where(table.c.id == sa.bindparam('b_id')),
+                             [{'b_id': 4}, {'b_id': 10}])
+        self.session.commit()
+        self.check_repository({'test': {'1.txt': "id: 1\nfoo: changed 1\nbar: x\n",
+                                        '2.txt': "id: 2\nfoo: changed 2\nbar: y\n",
+                                        '3.txt': "id: 3\nfoo: changed 3\nbar: default\n",
+                                        '11.txt': "id: 11\nfoo: probe 11\nbar: orm\n"}})
+
+        with self.assertRaises(NotImplementedError):
+            self.session.execute(table.delete().where(table.c.id > 1))
+        with self.assertRaises(NotImplementedError):
+            self.session.execute(table.update().where(table.c.id == sa.bindparam('b_id')),
+                                 [{'b_id': 1, 'id': 5}])
+        self.session.rollback()
+        self.restartRepo(reloadDatabase=True)
+        self.assertEqual(self.session.query(Test).count(), 4)
+
+    def test_git_call_deprecated(self):
+        self.initRepo()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(self.repo.gitCall(['rev-parse', '--git-dir']).strip(), '.git')
+        self.assertEqual([w.category for w in caught], [DeprecationWarning])
+
+    def test_unclosed_session_released(self):
+        import gc, weakref
+        self.initRepo()
+        engine = sa.create_engine('sqlite://')
+        gitdb_session = GitDBSession(sa.orm.sessionmaker(bind=engine)(), self.test_dir)
+        ref = weakref.ref(gitdb_session)
+        del gitdb_session
+        gc.collect()
+        self.assertIsNone(ref())
+
 
 class TypeTests(unittest.TestCase):
     def test_bool(self):
@@ -527,6 +1497,26 @@ class TypeTests(unittest.TestCase):
         self.assertEqual(data_types.TypeManager.type_dict[sa.String].to_string('foo\nbar'), 'foo\\nbar')
         self.assertEqual(data_types.TypeManager.type_dict[sa.String].from_string('foo\\nbar'), 'foo\nbar')
 
+    def test_codec(self):
+        Base = sqlalchemy.ext.declarative.declarative_base()
+        class Test(Base):
+            __tablename__ = 'test'
+            id = Column(Integer, primary_key = True)
+            name = Column('komischer_name', String)
+            foo = Column(String)
+            __content__ = 'foo'
+        codec = data_types.TypeManager.get_codec(Test)
+        self.assertIs(codec, data_types.TypeManager.get_codec(Test))
+        test = Test(id=1, name='bar\nbaz', foo='probe\nstring')
+        data = codec.dump(test)
+        self.assertEqual(data, 'komischer_name: bar\\nbaz\nid: 1\n\nprobe\nstring')
+        self.assertEqual(codec.dump_values({'id': 1, 'komischer_name': 'bar\nbaz', 'foo': 'probe\nstring'}), data)
+        self.assertEqual(codec.parse(data), {'id': 1, 'komischer_name': 'bar\nbaz', 'foo': 'probe\nstring'})
+        self.assertEqual(codec.parse('id: 2\n'), {'id': 2, 'komischer_name': None, 'foo': None})
+        self.assertEqual(codec.parse('id: 2\n', fill=False), {'id': 2})
+        self.assertEqual(codec.primary_key(test), '1')
+        self.assertEqual(construct_insert_values_from_string(Test, data), codec.parse(data))
+
 
 if __name__ == '__main__':
     import sys